@@ -8,16 +8,39 @@
 # 19.04.20 (v0.4.0) - added trend in view 'Average growth rate in the last seven days'
 # 21.06.20 (v0.5.0) - added continents based on country values; adjusted threshold values (days, min cases)
 # 02.07.20 (v0.6.0) - new: 'force' url param to force data reload
+# 18.10.26 (v0.7.0) - data is refreshed in a background thread, requests are served from the previous snapshot
+#                     fast start from a prebuilt snapshot (python -m lcd build-snapshot)
+#                     US counties and 'region' url param to show a region and its subregions
+#                     /compare to compare the series of given countries
+#                     archive of all data versions and 'as_of' url param to show the data of a past day
+#                     client rendering mode (/client/<view>/): the browser draws the bars from the data API
+#                     pluggable data sources (lcd_sources.py), e.g. files in a local directory instead of Github
 #
-__version__ = "v0.6.0"
+__version__ = "v0.7.0"
 
-import pandas
-import urllib.request
+import os
+import sys
+import numpy
+import hashlib
+import warnings
+import threading
 
-from flask import Flask, render_template, request
+from flask import Flask, Response, abort, render_template, request, stream_template
+from functools import wraps
 from time import time, localtime, strftime
-from lcd_country_data import get_country_population, get_country_continent
-from math import log10, isinf, isnan
+from lcd_country_data import country_table
+from lcd_store import SeriesTable, TableView, RankIndex, make_snapshot, argsort_descending, page_bounds, relative_values
+from lcd_cache import LRUCache, CompressedPage, stream_encoded
+from lcd_snapshot import SnapshotFile, read_snapshot_file, write_snapshot_file
+from lcd_sources import JHUSource, LocalDirectorySource
+from lcd_rebuild import ParallelRebuild
+from lcd_metrics import ENABLED as METRICS_ENABLED, add_server_timing, metrics_view, stage, timed
+from lcd_api import create_api
+from lcd_analytics import METRICS, Analytics
+from lcd_hierarchy import COUNTRY
+from lcd_archive import SnapshotArchive, parse_as_of
+from math import isnan
+from concurrent.futures import ThreadPoolExecutor
 
 CONFIRMED_GLOBAL_URL = "https://github.com/CSSEGISandData/COVID-19/raw/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv"
 CONFIRMED_GLOBAL_FILE = "time_series_covid19_confirmed_global.csv"
@@ -25,154 +48,176 @@ DEATHS_GLOBAL_URL = "https://github.com/CSSEGISandData/COVID-19/raw/master/csse_
 DEATHS_GLOBAL_FILE = "time_series_covid19_deaths_global.csv"
 RECOVERED_GLOBAL_URL = "https://github.com/CSSEGISandData/COVID-19/raw/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_recovered_global.csv"
 RECOVERED_GLOBAL_FILE = "time_series_covid19_recovered_global.csv"
+CONFIRMED_US_URL = "https://github.com/CSSEGISandData/COVID-19/raw/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_US.csv"
+CONFIRMED_US_FILE = "time_series_covid19_confirmed_US.csv"
+DEATHS_US_URL = "https://github.com/CSSEGISandData/COVID-19/raw/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_US.csv"
+DEATHS_US_FILE = "time_series_covid19_deaths_US.csv"
+
+REFRESH_INTERVAL = 4 * 3600     # secs between two data reloads
+RETRY_INTERVAL = 300            # secs to wait after a failed data reload
+QUERY_CACHE_SIZE = 256          # max. number of computed views kept per dataset
+QUERY_CACHE_BYTES = 64 << 20    # max. total size of the computed views kept per dataset
+PAGE_CACHE_SIZE = 128           # max. number of rendered pages kept
+PAGE_CACHE_BYTES = 32 << 20     # max. total size of the rendered pages kept (compressed)
+ARCHIVE_CACHE_SIZE = 4          # max. number of snapshots of archived versions kept per dataset
+STREAM_CELLS = 20000            # pages with more values are streamed while rendered instead of cached
+STREAM_CHUNK_ROWS = 16          # rows converted for the template at a time when streaming
+CLIENT_SHELL_MAX_AGE = 86400    # secs browsers may keep the page of the client rendering mode without asking
+PAGE_PARAMS = {'days': int, 'cases': int, 'country': str, 'region': str, 'countries': str, 'metric': str,
+               'view': str, 'limit': int, 'offset': int, 'as_of': str}     # url params a page depends on, with their type
+SNAPSHOT_FILE = os.environ.get('LCD_SNAPSHOT_FILE', '')    # written by lcd_snapshot.py, shared by all workers
+INGEST_DAYS = int(os.environ.get('LCD_INGEST_DAYS', '0'))   # parse only the last N days (0: all), at least 13
+WARM_SNAPSHOT = os.environ.get('LCD_WARM_SNAPSHOT', '')    # prebuilt by 'python -m lcd build-snapshot', served from the start
+PARALLEL_REBUILD = os.environ.get('LCD_PARALLEL_REBUILD', '') == '1'    # rebuild all datasets together in worker processes
+ARCHIVE_DIR = os.environ.get('LCD_ARCHIVE_DIR', '')        # keep every version of the data there, see lcd_archive.py
+SOURCE_DIR = os.environ.get('LCD_SOURCE_DIR', '')          # read the JHU files from there instead of Github, see lcd_sources.py
+
+CONTINENTS = country_table.continents
+
+def query_size(value):
+    '''Returns the bytes held by an entry of a query cache: a TableView or a region Snapshot (without the shared values).'''
+    if isinstance(value, TableView):
+        return value.rows.nbytes + value.values.nbytes
+    return sum(table.nbytes - table.values.nbytes for table in (value.abs_table, value.dif_table))
+
+def jhu_source(filename, url):
+    '''Returns the source of JHU file <filename>: downloaded from <url>, or read from SOURCE_DIR if set.'''
+    if SOURCE_DIR:
+        return LocalDirectorySource(SOURCE_DIR, filename, last_days=INGEST_DAYS or None)
+    return JHUSource(filename, url, INGEST_DAYS or None)
 
 class CovidData:
-    def __init__(self, filepath, url):
-        self.filepath = filepath
-        self.url = url
-        self.df = None
-        self.df_abs = None
-        self.df_dif = None
-        self.last_update_time = 0.0
-    
-    def _insert_pop_column(self, df):
-        '''Insert population column in mn at pos 0 in dataframe.'''
-        population = []
-        countries = list(df.index.values)
-        for country in countries:
-            population.append(get_country_population(country))
-        df.insert(0, 'Population', population)
-        return df
-
-    def _insert_continents_column(self, df):
-        '''Insert continent column at pos 0 in dataframe.'''
-        countries = list(df["Country/Region"])
-        continents = [get_country_continent(country) for country in countries]
-        df.insert(0, 'Continent', continents)
-        return df
-
-    def _insert_continent_rows(self, df):
-        '''Compute values for continents based on countries an insert as rows'''
-        df_tmp = df.copy()
-        df_tmp = self._insert_continents_column(df_tmp)
-        date_columns = list(df_tmp.columns)[2:]
-        col_dict = {col:'sum' for col in date_columns}
-        df_tmp = df_tmp.groupby("Continent").agg(col_dict)
-        df_tmp.loc['[World]'] = df_tmp.sum()    # insert 'World' row
-        df_tmp.index.name = 'Country/Region'
-        df_tmp = df_tmp.reset_index()
-        df_result = df.append(df_tmp)
-        return df_result.sort_values(df_result.columns[-1], ascending = False)
-
-    def _insert_residents_per_case_column(self, df):
-        '''
-        Insert residents per case column at pos 1 in dataframe.
-        Population column must exist!
-        '''
-        residents_per_case = []
-        populations = list(df['Population'])
-        latest_cases = list(df[df.columns[-1]])
-        for po, lc in zip(populations, latest_cases):
-            try:
-                residents_per_case.append(round(po * 1000000 / lc))
-            except ZeroDivisionError:
-                residents_per_case.append(0)
-        df.insert(1, 'Residents per case', residents_per_case)
-        return df
-
-    def _insert_trend_column(self, df, distance):
+    def __init__(self, filepath='', url='', source=None, name=''):
+        self.source = source or JHUSource(filepath, url, INGEST_DAYS or None)
+        self.filepath = self.source.filepath
+        self.name = name or os.path.basename(self.filepath)    # key of its snapshot in snapshot files
+        self.snapshot = None
+        self.scheduler = None
+        self.snapshot_file = None
+        self.warm = False           # snapshot loaded from a prebuilt file, not parsed by this process
+        self.pending = False        # the source reported a change that is not in the snapshot yet (parse or commit failed)
+        self.query_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_BYTES, query_size)
+        self.archive = SnapshotArchive(os.path.join(ARCHIVE_DIR, os.path.basename(self.filepath))) if ARCHIVE_DIR else None
+        self.archived_snapshots = LRUCache(ARCHIVE_CACHE_SIZE)
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def abs_table(self):
+        return self.snapshot.abs_table if self.snapshot else None
+
+    @property
+    def dif_table(self):
+        return self.snapshot.dif_table if self.snapshot else None
+
+    @property
+    def last_update_time(self):
+        return self.snapshot.last_update_time if self.snapshot else 0.0
+
+    @property
+    def version(self):
+        return self.snapshot.version if self.snapshot else 0
+
+    @stage('population_column')
+    def _population_column(self, regions):
+        '''Returns population in mn for each region. Unknown regions get 0.'''
+        return country_table.population(regions)
+
+    @stage('continent_column')
+    def _continent_column(self, regions):
+        '''Returns continent of each region as code into CONTINENTS, -1 if n/a.'''
+        return country_table.continent(regions)
+
+    @stage('residents_per_case_column')
+    def _residents_per_case_column(self, population, latest_cases):
+        '''Returns residents per case computed from population in mn and latest cases, 0 if there is no case.'''
+        residents = population * 1000000
+        latest_cases = latest_cases.astype('float64')
+        residents_per_case = numpy.zeros(len(population))
+        numpy.divide(residents, latest_cases, out=residents_per_case, where=latest_cases != 0)
+        return numpy.rint(residents_per_case).astype('int64')
+
+    @stage('trend_column')
+    def _trend_column(self, values, distance):
         '''
-        Insert trend column at pos 2 in dataframe.
+        Returns trend in % for each row of <values>.
         Trend means percentage rate of increase of two consecutive periods described by <distance> in days.
+        Trend is NaN if it can't be computed (no increase in the previous period).
+        '''
+        last = values[:, -1].astype('float64')
+        middle = values[:, -(1 + distance)].astype('float64')
+        first = values[:, -(1 + 2 * distance)].astype('float64')
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            quot = (last - middle) / (middle - first)
+        trend = numpy.rint(-(1 - quot) * 100)
+        trend[~numpy.isfinite(trend)] = numpy.nan
+        return trend
+
+    def _build_table(self, regions, dates, values, order, countries=None):
+        '''
+        Returns SeriesTable of <values> (rows in order of <regions>) including metadata columns.
+        <order> are the row indices sorted by last column.
+        Population and continent are only looked up for the rows marked in <countries> (all if None),
+        so provinces named like a country don't get its metadata.
+        '''
+        regions = [regions[row] for row in order]
+        if countries is None:
+            population, continent = self._population_column(regions), self._continent_column(regions)
+        else:
+            names = [region for region, country in zip(regions, countries.tolist()) if country]
+            population, continent = numpy.zeros(len(regions)), numpy.full(len(regions), -1, dtype='int8')
+            population[countries], continent[countries] = self._population_column(names), self._continent_column(names)
+        return SeriesTable(regions, dates, values,
+                           population=population,
+                           residents_per_case=self._residents_per_case_column(population, values[order, -1]),
+                           trend=self._trend_column(values, 6)[order],
+                           continent=continent,
+                           continents=CONTINENTS,
+                           value_rows=order)
+
+    def _build_tables(self, tree, rows, dates, abs_values, dif_values):
+        '''
+        Returns tables of absolute and of differential numbers of the nodes <rows> of <tree>.
+        <abs_values> and <dif_values> hold every node of the tree, see TimeSeriesIngest.
+        '''
+        abs_order = rows[argsort_descending(abs_values[rows, -1])]
+        dif_order = abs_order[argsort_descending(dif_values[abs_order, -1])]   # ties ordered like in abs table
+        abs_table = self._build_table(tree.names, dates, abs_values, abs_order)
+        dif_table = self._build_table(tree.names, dates[1:], dif_values, dif_order)
+        return abs_table, dif_table
+
+    def _compute_tables(self):
+        '''
+        Parse the fetched file of the source and return tables of absolute and of differential numbers and the region tree.
+        The tables show countries, continents and the world, their values hold every node of the tree.
+        Only the date columns added since the last reload are parsed if the source supports it.
+        '''
+        with timed('parse'):
+            parsed = self.source.parse()
+        abs_table, dif_table = self._build_tables(parsed.tree, parsed.region_rows, parsed.dates, parsed.abs_values, parsed.dif_values)
+        print("%d of %d days parsed..." % (parsed.days_parsed, len(parsed.dates)))
+        return abs_table, dif_table, parsed.tree
+
+    @stage('agr_values')
+    def _compute_agr_values(self, values):
+        '''Returns average growth rate in % of each row of <values>, rounded to one digit.'''
+        values = values.astype('float64')
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            pct_change = values[:, 1:] / values[:, :-1] - 1
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)     # mean of rows with NaN only is NaN
+            agr = numpy.nanmean(pct_change, axis=1)
+        return numpy.round(agr * 100, 1)
+
+    @stage('double_rates')
+    def _compute_double_rates(self, agr):
+        '''
+        Compute double rates from percentage increase (e.g. 9.2).
+        No increase yields 0, a decrease of 100 % or more yields NaN.
         '''
-        diff1 = df[df.columns[-1]] - df[df.columns[-(1 + distance)]]
-        diff2 = df[df.columns[-(1 + distance)]] - df[df.columns[-(1 + 2 * distance)]]
-        quot = diff1 / diff2
-        quot = -(1 - quot) * 100
-        ql = [round(x) if not (isinf(x) or isnan(x)) else "n/a at this time" for x in list(quot)]
-        df.insert(2, 'Trend', ql)
-        return df
-
-    def _drop_rows_based_on_unique_indicis(self, df_source, df_target):
-        '''Drop every row in df_target where the row index is not contained in df_source'''
-        set_of_source_indicis = set(df_source.index)
-        set_of_target_indicis = set(df_target.index)
-        list_of_indicis_in_target_but_not_in_source = [i for i in set_of_target_indicis if i not in set_of_source_indicis]
-        df = df_target.drop(list_of_indicis_in_target_but_not_in_source)
-        return df
-
-    def _convert_all_floats_to_ints(self, df):
-        '''Convert all float numbers to int numbers in a given dataframe.'''    
-        float_col = df.select_dtypes(include=['float64']) # this will select float columns only
-        for col in float_col.columns.values:
-            df[col] = df[col].astype('int64')
-        return df
-
-    def _condense_and_sort_dataframe(self, df):
-        '''Condense dataframe to only one country per row and sort by last column.'''
-        date_columns = list(df.columns)[1:]
-        col_dict = {}
-        for col in date_columns: col_dict[col] = 'sum'
-        df = df.groupby("Country/Region").agg(col_dict)
-        df = df.sort_values(df.columns[-1], ascending = False)
-        return df
-
-    def _compute_rel_dataframe(self, df):
-        '''
-        Compute dataframe with relative numbers (%) from dataframe with absolute numbers.
-        Relative numbers (percent values) are used for length of bargraphs.
-        Negative numbers are set to zero!
-        '''
-        residents_per_case = list(df['Residents per case'])                     # save column
-        population = list(df['Population'])                                     # save column
-        trend = list(df['Trend'])                                               # save column
-        df_tmp = df.drop(['Population','Residents per case', 'Trend'], axis=1)  # delete columns from dataframe
-        max_value = df_tmp.max().max()                                          # compute max value
-        df_rel = df_tmp.div(max_value).multiply(100).round(1)                   # compute relative values
-        df_rel[df_rel < 0] = 0                                                  # set negative numbers to 0
-        df_rel.insert(0, 'Population', population)                              # restore column
-        df_rel.insert(1, 'Residents per case', residents_per_case)              # restore column
-        df_rel.insert(2, 'Trend', trend)                                        # restore column        
-        return df_rel
-
-    def _compute_abs_dataframe(self):
-        df_abs = pandas.read_csv(self.filepath)
-        df_abs = df_abs.drop(["Province/State", "Lat", "Long"], axis=1)
-        df_abs = self._insert_continent_rows(df_abs)
-        df_abs = self._condense_and_sort_dataframe(df_abs)
-       #df_abs.to_csv('abs.csv', encoding='utf-8')
-        return df_abs
-
-    def _compute_dif_dataframe(self):
-        '''
-        Compute differential dataframe by substraction each col from prev col.
-
-        First col becomes NaN and is therefore dropped.
-        Sort by last column.
-        '''
-        df_dif = self.df_abs.diff(axis=1)
-        df_dif = df_dif.sort_values(df_dif.columns[-1], ascending = False)
-        df_dif = df_dif.drop(df_dif.columns[0], axis=1)
-        df_dif = self._convert_all_floats_to_ints(df_dif)
-        return df_dif
-
-    def _compute_agr_dataframe(self, df):
-        '''Compute dataframe with average growth rate, sorted by last column.'''
-        residents_per_case = list(df['Residents per case'])                     # save column
-        population = list(df['Population'])                                     # save column
-        trend = list(df['Trend'])                                               # save column
-        df_tmp = df.drop(['Population','Residents per case', 'Trend'], axis=1)  # delete columns from dataframe
-        df_agr = df_tmp.pct_change(axis=1)                                      # compute percentage change
-        df_agr = df_agr.drop(df_agr.columns[0], axis=1)                         # first column becomes NaN -> drop
-        si_pct = df_agr.mean(axis=1)                                            # compute mean values (returns series, not dataframe!)
-        si_pct = si_pct.multiply(100).round(1)                                  # adjust 0.1234 -> 12.3
-        df_agr.insert(0, 'Population', population)                              # restore column
-        df_agr.insert(1, 'Residents per case', residents_per_case)              # restore column
-        df_agr.insert(2, 'Trend', trend)                                        # restore column
-        df_agr.insert(3, 'AGR (mean value)', list(si_pct))                      # save mean values
-        df_agr = df_agr.iloc[:, list(range(4))]                                 # drop evrything after column 'Mean Values'
-        df_agr = df_agr.sort_values(df_agr.columns[-1], ascending = False)      # sort by 'Mean Values'
-        return df_agr
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            double_rates = numpy.round(numpy.log10(2) / numpy.log10(1 + agr / 100), 1)
+        double_rates[agr == 0] = 0
+        return double_rates
 
     def is_dirty(self, secs):
         '''
@@ -180,180 +225,688 @@ class CovidData:
         '''
         return time() - self.last_update_time > secs
 
-    def _check_for_update(self, force_reload=False):
+    def _build_snapshot(self, changed=None):
+        '''
+        Fetch data from the source and parse into a new snapshot.
+
+        On the very first load an intact local copy is parsed without fetching it.
+        If the source reports the data as unchanged (and no earlier change is pending) the current tables are kept.
+        <changed> is the result of source.fetch() if the caller did already fetch the file.
+        '''
+        update_time = self.source.local_copy_time() if self.snapshot is None else None
+        if update_time is None:
+            if changed is None:
+                with timed('download'):
+                    changed = self.source.fetch()
+            self.pending = self.pending or changed
+            if not self.pending and self.snapshot is not None and not self.warm:
+                print("data unchanged...")
+                return self.snapshot._replace(last_update_time=time())
+            update_time = time()
+        abs_table, dif_table, tree = self._compute_tables()
+        print("data reloaded...")
+        return make_snapshot(abs_table, dif_table, update_time, self.version + 1, tree)
+
+    def refresh(self, force_reload=False, changed=None):
         '''
-        Download data from Github and parse into dataframes if last update does exceed
-        specified amount of secs or force_reload is true.
-        '''        
-        if self.is_dirty(4 * 3600) or force_reload:
-            urllib.request.urlretrieve(self.url, self.filepath)
-            self.df_abs = self._compute_abs_dataframe()
-            self.df_dif = self._compute_dif_dataframe()
-            # Insert population column at pos 0 in dataframe
-            self.df_abs = self._insert_pop_column(self.df_abs)
-            self.df_dif = self._insert_pop_column(self.df_dif)
-            # Insert residents per case column at pos 1 in dataframe
-            self.df_abs = self._insert_residents_per_case_column(self.df_abs)
-            self.df_dif = self._insert_residents_per_case_column(self.df_dif)
-            # Insert trend column at pos 2 in dataframe
-            self.df_abs = self._insert_trend_column(self.df_abs, 6)
-            self.df_dif = self._insert_trend_column(self.df_dif, 6)
-            self.last_update_time = time()
-            print("data reloaded...")
-
-    def _prune_dataframe(self, df, cases, days):
-        '''
-        Discard all columns before <days> and all rows with less than <cases> in last column but only if cases > 0.
-        '''
-        df = df.iloc[:, [0, 1, 2] + list(range(-days, 0))]
-        if cases > 0:
-            last_column = list(df.columns)[-1]
-            df = df[df[last_column] >= cases]
-        return df
-
-    def _shrink_dataframe(self, df, country):
-        '''Discard all rows before <country>'''
+        Rebuild the snapshot if last update does exceed REFRESH_INTERVAL or force_reload is true.
+        If the caller did already fetch the file, <changed> is the result of source.fetch()
+        and the snapshot is always rebuilt from the downloaded file.
+
+        The previous snapshot is served until the new one is swapped in.
+        Concurrent callers share one rebuild: whoever waited for the lock
+        while another thread rebuilt the snapshot returns without reloading.
+        '''
+        snapshot = self.snapshot
+        with self._refresh_lock:
+            if self.snapshot is not snapshot:
+                return
+            if self.is_dirty(REFRESH_INTERVAL) or force_reload or changed is not None:
+                self.snapshot = self._build_snapshot(changed)
+                self.warm = self.pending = False
+                if snapshot is None or self.snapshot.version != snapshot.version:
+                    self.archive_snapshot()
+
+    def archive_snapshot(self):
+        '''Append the data of the current snapshot to the archive (if any); a failure only costs this version.'''
+        snapshot = self.snapshot
+        if self.archive is None or snapshot.tree is None:
+            return
         try:
-            row_index = df.index.get_loc(country)
-        except KeyError:
-            if country != "":
-                print(country, 'not found in row index')
+            with timed('archive'):
+                self.archive.append(snapshot.tree, snapshot.abs_table.dates, snapshot.abs_table.values, snapshot.last_update_time)
+        except Exception as e:
+            print("archiving failed:", self.filepath, e)
+
+    def _build_archived_snapshot(self, version):
+        archived = self.archive.load(version)
+        dif_values = numpy.diff(archived.values, axis=1)
+        abs_table, dif_table = self._build_tables(archived.tree, archived.tree.country_nodes(), archived.dates, archived.values, dif_values)
+        return make_snapshot(abs_table, dif_table, archived.archive_time, ('archive', version), archived.tree)
+
+    def archived_snapshot(self, as_of):
+        '''
+        Returns Snapshot of the data as shown at timestamp <as_of>, i.e. of the last version archived
+        before, None if there is none. Its version is ('archive', number), so cached views of it never
+        mix with the ones of the current snapshot.
+        '''
+        version = self.archive.version_at(as_of) if self.archive is not None else None
+        if version is None:
+            return None
+        return self.archived_snapshots.get_or_compute(version, lambda: self._build_archived_snapshot(version))
+
+    def _served_snapshot(self, as_of=None):
+        '''Returns the current snapshot, or with timestamp <as_of> the archived one, see archived_snapshot().'''
+        if as_of is None:
+            return self.snapshot
+        snapshot = self.archived_snapshot(as_of)
+        if snapshot is None:
+            raise LookupError("no data archived as of " + strftime('%Y-%m-%d %H:%M', localtime(as_of)))
+        return snapshot
+
+    def _map_snapshot(self):
+        '''Swap in the snapshot stored in the snapshot file, returns False if there is none.'''
+        snapshot = self.snapshot_file.get(self.name)
+        if snapshot is None:
+            return False
+        if self.snapshot is not None and snapshot.version <= self.snapshot.version and snapshot is not self.snapshot:
+            self.query_cache.clear()        # builder was restarted and counts versions from the beginning
+        self.snapshot = snapshot
+        return True
+
+    def _check_for_update(self, force_reload=False):
+        '''
+        Make sure there is a snapshot to serve and hand reloads over to the scheduler.
+        Only the very first request has to wait for the data.
+        Workers sharing a snapshot file just pick up the latest snapshot written by the builder.
+        '''
+        if self.snapshot_file is not None and self._map_snapshot():
+            return
+        if self.snapshot is None:
+            self.refresh()
+        if self.scheduler is None:
+            self.refresh(force_reload)
+        elif self.is_dirty(REFRESH_INTERVAL) or force_reload:
+            self.scheduler.trigger(self if force_reload else None)
+        else:
+            self.scheduler.start()
+
+    def _build_region_snapshot(self, snapshot, node):
+        '''Returns Snapshot of the tables of <node> of the region tree and its subregions.'''
+        tree, abs_table, dif_table = snapshot.tree, snapshot.abs_table, snapshot.dif_table
+        rows = tree.subregions(node)
+        regions = list(tree.names)
+        regions[node] = tree.keys[node]             # e.g. 'US/New York', a county may be named like its state
+        abs_order = rows[argsort_descending(abs_table.values[rows, -1])]
+        dif_order = abs_order[argsort_descending(dif_table.values[abs_order, -1])]
+        abs_table = self._build_table(regions, abs_table.dates, abs_table.values, abs_order, tree.level[abs_order] <= COUNTRY)
+        dif_table = self._build_table(regions, dif_table.dates, dif_table.values, dif_order, tree.level[dif_order] <= COUNTRY)
+        return make_snapshot(abs_table, dif_table, snapshot.last_update_time, snapshot.version, tree)
+
+    def _region_snapshot(self, snapshot, region):
+        '''
+        Returns Snapshot of <region> (see RegionTree.find) and its subregions, built once per version.
+        Without <region> or if it is not in the region tree the snapshot itself is returned.
+        '''
+        if region == "" or snapshot.tree is None:
+            return snapshot
+        node = snapshot.tree.find(region)
+        if node is None:
+            print(region, 'not found in region tree')
+            return snapshot
+        return self.query_cache.get_or_compute(('region', region, snapshot.version),
+                                               lambda: self._build_region_snapshot(snapshot, node))
+
+    def _shrink_rows(self, table, rows, country):
+        '''Discard all row indices in <rows> (sorted) before the row of <country>'''
+        shrunk = RankIndex.jump_to(table, rows, country)
+        if shrunk is not None:
+            return shrunk
+        if country != "":
+            print(country, 'not found in row index')
+        return rows
+
+    def _abs_view(self, snapshot, days, cases, country):
+        table = snapshot.abs_table
+        days = min(max(days, 1), len(table.dates))
+        rows = snapshot.index.abs_rows(cases)
+        rows = self._shrink_rows(table, rows, country)
+        return TableView(table, rows, table.select(rows, days), table.dates[-days:], table.dates[-days], table.dates[-1])
+
+    def _dif_view(self, snapshot, days, cases, country):
+        abs_table, dif_table = snapshot.abs_table, snapshot.dif_table
+        days = min(max(days, 1), len(dif_table.dates))
+        rows = snapshot.index.dif_rows(cases)                                      # Countries in corresponding abs values for <cases>.
+        rows = self._shrink_rows(dif_table, rows, country)                          # Put country on top of the list if applicable.
+        return TableView(dif_table, rows, dif_table.select(rows, days), dif_table.dates[-days:], abs_table.dates[-days], abs_table.dates[-1])
+
+    def _agr_view(self, snapshot, days, cases, country):
+        '''Average growth rate and double rate of the last seven days (<days> and <country> are not used).'''
+        table = snapshot.abs_table
+        rows = snapshot.index.abs_rows(cases)
+        agr = self._compute_agr_values(table.select(rows, 8))
+        order = argsort_descending(agr)                                        # sort by average growth rate
+        rows, agr = rows[order], agr[order]
+        values = numpy.column_stack([agr, self._compute_double_rates(agr)])
+        return TableView(table, rows, values, ['AGR (mean value)', 'double_rates'], table.dates[-8], table.dates[-1])
+
+    def _compare_view(self, snapshot, view, regions, days):
+        '''
+        Returns TableView of <view> ('abs', 'dif' or a metric in METRICS) of the last <days> of <regions>,
+        rows in the order of <regions>. Only the rows of these regions are read from the SeriesStore.
+        '''
+        store = snapshot.series
+        regions, rows = store.lookup(regions)
+        source = store.dif_table if view == 'dif' else store.abs_table
+        table = self._build_table(dict(zip(rows.tolist(), regions)), source.dates, source.values, rows, store.countries(rows))
+        order = numpy.arange(len(table))
+        dates = store.abs_table.dates
+        if view in METRICS:
+            series, window = Analytics(table).metric(view)
+            days = max(min(days, len(dates) - window), 1)
+            values = numpy.round(series[:, -days:], 1)
+        else:
+            days = min(max(days, 1), len(table.dates))
+            values = table.select(order, days)
+        return TableView(table, order, values, table.dates[-days:], dates[-days], dates[-1])
+
+    @stage('compare_view')
+    def compare_view(self, view, countries, days, force_reload=False, as_of=None):
+        '''Returns TableView of <view> of the regions in comma separated <countries> (see _compare_view) of the served snapshot.'''
+        self._check_for_update(force_reload)
+        snapshot = self._served_snapshot(as_of)
+        key = ('compare', view, countries, days, snapshot.version)
+        return self.query_cache.get_or_compute(key, lambda: self._compare_view(snapshot, view, snapshot.series.split(countries), days))
+
+    def _is_streamed(self, view, limit, offset):
+        start, stop = page_bounds(len(view.rows), limit, offset)
+        return (stop - start) * view.values.shape[1] > STREAM_CELLS
+
+    def _chunked_rows(self, table, rows, values):
+        '''Generates the template rows of <rows> and <values> converted STREAM_CHUNK_ROWS at a time.'''
+        for start in range(0, len(rows), STREAM_CHUNK_ROWS):
+            yield from table.to_rows(rows[start:start + STREAM_CHUNK_ROWS], values[start:start + STREAM_CHUNK_ROWS])
+
+    def _metric_view(self, snapshot, metric, days, cases, country):
+        '''
+        Precomputed series of <metric> (see METRICS) of the last <days>, rows like in the abs view.
+        Rows without a latest value (e.g. incidence of a country with unknown population) are left out.
+        '''
+        table = snapshot.abs_table
+        series, window = snapshot.analytics.metric(metric)
+        days = max(min(days, len(table.dates) - window), 1)
+        rows = self._shrink_rows(table, snapshot.index.abs_rows(cases), country)
+        rows = rows[~numpy.isnan(series[rows, -1])]
+        return TableView(table, rows, numpy.round(series[rows, -days:], 1), table.dates[-days:], table.dates[-days], table.dates[-1])
+
+    def _template_values(self, view, bars=None, limit=0, offset=0):
+        '''
+        Returns rows of values and rows of relative values of the first <bars> value columns
+        (all if None) as used by the template, plus first and last date.
+        Only the <limit> rows (all if 0) starting at <offset> are converted; bars stay relative to the whole view.
+        Pages with more than STREAM_CELLS values are returned as generators, to be streamed by render_page().
+        '''
+        start, stop = page_bounds(len(view.rows), limit, offset)
+        rows, values = view.rows[start:stop], view.values[start:stop]
+        rel_values = relative_values(view.values[:, :bars])[start:stop]
+        if self._is_streamed(view, limit, offset):
+            return (self._chunked_rows(view.table, rows, values), self._chunked_rows(view.table, rows, rel_values),
+                    view.dat_start, view.dat_end)
+        return view.table.to_rows(rows, values), view.table.to_rows(rows, rel_values), view.dat_start, view.dat_end
+
+    def _cached_template_values(self, snapshot, view, days, cases, country, region, limit, offset, bars=None):
+        '''
+        Returns _template_values() of the cached TableView of <view>. The template rows themselves are not
+        cached: as python lists they take many times the memory of the arrays, and the rendered page is cached.
+        '''
+        table_view = self._cached_view(snapshot, view, days, cases, country, region)
+        return self._template_values(table_view, bars, limit, offset)
+
+    def _cached_view(self, snapshot, view, days, cases, country, region=""):
+        if view == 'agr':
+            days, country = 8, ""
+        if view in METRICS:
+            compute = lambda snapshot, days, cases, country: self._metric_view(snapshot, view, days, cases, country)
         else:
-            df = df.iloc[row_index:]
-        return df
+            compute = getattr(self, '_%s_view' % view)
+        key = (view, days, cases, country, region, snapshot.version)
+        return self.query_cache.get_or_compute(key, lambda: compute(self._region_snapshot(snapshot, region), days, cases, country))
 
-    def _append_double_rates_to_df_agr(self, df_agr):
+    @stage('compute_view')
+    def compute_view(self, view, days, cases, country="", force_reload=False, region="", as_of=None):
         '''
-        Compute double rates from percentage increase and append as new column.
-        Last col of <df> contains percentage increase (e.g. 9.2).
+        Returns TableView of <view> ('abs', 'dif', 'agr' or a metric in METRICS) of the current snapshot.
+        With <region> the view shows this region and its subregions instead of all countries,
+        with timestamp <as_of> the data archived at that time.
         '''
-        def f(x):
-            try:
-                fx = round(log10(2) / log10(1 + x / 100), 1)
-            except ZeroDivisionError:
-                fx = 0
-            return fx
-        double_rates = [f(x) for x in df_agr["AGR (mean value)"]]
-        df_agr['double_rates'] = double_rates
-        return df_agr
-
-    def compute_abs_values(self, days, cases, country="", force_reload=False):
         self._check_for_update(force_reload)
-        df_abs_tmp = self._prune_dataframe(self.df_abs, cases, days)
-        df_abs_tmp = self._shrink_dataframe(df_abs_tmp, country)
-        df_rel_tmp = self._compute_rel_dataframe(df_abs_tmp)
-        abs_values = df_abs_tmp.reset_index().values.tolist()
-        rel_values = df_rel_tmp.reset_index().values.tolist()
-        dat_start = df_abs_tmp.columns[3]
-        dat_end = df_abs_tmp.columns[-1]
-        return abs_values, rel_values, dat_start, dat_end
-
-    def compute_dif_values(self, days, cases, country="", force_reload=False):
+        return self._cached_view(self._served_snapshot(as_of), view, days, cases, country, region)
+
+    @stage('compute_abs_values')
+    def compute_abs_values(self, days, cases, country="", force_reload=False, limit=0, offset=0, region="", as_of=None):
+        self._check_for_update(force_reload)
+        return self._cached_template_values(self._served_snapshot(as_of), 'abs', days, cases, country, region, limit, offset)
+
+    @stage('compute_dif_values')
+    def compute_dif_values(self, days, cases, country="", force_reload=False, limit=0, offset=0, region="", as_of=None):
+        self._check_for_update(force_reload)
+        return self._cached_template_values(self._served_snapshot(as_of), 'dif', days, cases, country, region, limit, offset)
+
+    @stage('compute_metric_values')
+    def compute_metric_values(self, metric, days, cases, country="", force_reload=False, limit=0, offset=0, region="", as_of=None):
         self._check_for_update(force_reload)
-        df_abs_tmp = self._prune_dataframe(self.df_abs, cases, days)                    # Create corresponding df_abs for <cases>.
-        df_dif_tmp = self._drop_rows_based_on_unique_indicis(df_abs_tmp, self.df_dif)   # Drop countries which are not in corresponding df_abs.
-        df_dif_tmp = self._prune_dataframe(df_dif_tmp, 0, days)                         # Only look at last <days>. Leave cases as is.
-        df_dif_tmp = self._shrink_dataframe(df_dif_tmp, country)                        # Put country on top of the list if applicable.
-        df_rel_tmp = self._compute_rel_dataframe(df_dif_tmp)
-        dif_values = df_dif_tmp.reset_index().values.tolist()
-        rel_values = df_rel_tmp.reset_index().values.tolist()
-        dat_start = df_abs_tmp.columns[3]
-        dat_end = df_abs_tmp.columns[-1]
-        return dif_values, rel_values, dat_start, dat_end
-
-    def compute_agr_values(self, cases, force_reload=False):
+        return self._cached_template_values(self._served_snapshot(as_of), metric, days, cases, country, region, limit, offset)
+
+    @stage('compute_compare_values')
+    def compute_compare_values(self, view, countries, days, force_reload=False, limit=0, offset=0, as_of=None):
+        return self._template_values(self.compare_view(view, countries, days, force_reload, as_of), None, limit, offset)
+
+    @stage('compute_agr_values')
+    def compute_agr_values(self, cases, force_reload=False, limit=0, offset=0, region="", as_of=None):
         self._check_for_update(force_reload)
-        df_abs_tmp = self._prune_dataframe(self.df_abs, cases, 8)
-        df_agr_tmp = self._compute_agr_dataframe(df_abs_tmp)
-        df_rel_tmp = self._compute_rel_dataframe(df_agr_tmp)
-        df_agr_tmp = self._append_double_rates_to_df_agr(df_agr_tmp)
-        agr_values = df_agr_tmp.reset_index().values.tolist()
-        rel_values = df_rel_tmp.reset_index().values.tolist()
-        dat_start = df_abs_tmp.columns[3]
-        dat_end = df_abs_tmp.columns[-1]
-        return agr_values, rel_values, dat_start, dat_end
-
-coviddata_confirmed = CovidData(CONFIRMED_GLOBAL_FILE, CONFIRMED_GLOBAL_URL)
-coviddata_deaths = CovidData(DEATHS_GLOBAL_FILE, DEATHS_GLOBAL_URL) 
-coviddata_recovered = CovidData(RECOVERED_GLOBAL_FILE, RECOVERED_GLOBAL_URL) 
+        return self._cached_template_values(self._served_snapshot(as_of), 'agr', 8, cases, "", region, limit, offset, bars=1)
+
+coviddata_confirmed = CovidData(source=jhu_source(CONFIRMED_GLOBAL_FILE, CONFIRMED_GLOBAL_URL), name='confirmed')
+coviddata_deaths = CovidData(source=jhu_source(DEATHS_GLOBAL_FILE, DEATHS_GLOBAL_URL), name='deaths')
+coviddata_recovered = CovidData(source=jhu_source(RECOVERED_GLOBAL_FILE, RECOVERED_GLOBAL_URL), name='recovered')
+coviddata_confirmed_us = CovidData(source=jhu_source(CONFIRMED_US_FILE, CONFIRMED_US_URL), name='confirmed_us')
+coviddata_deaths_us = CovidData(source=jhu_source(DEATHS_US_FILE, DEATHS_US_URL), name='deaths_us')
+
+class RefreshScheduler:
+    '''
+    Reload a set of CovidData instances in a background thread, off the request path.
+
+    The thread is started lazily by the first request so that it also runs in
+    forked worker processes. Any number of triggers arriving while a reload is
+    in progress are coalesced into at most one further reload.
+    The sources of all due datasets are fetched concurrently.
+    With <rebuild> (a ParallelRebuild) all datasets are reloaded together.
+    '''
+    def __init__(self, datasets, interval=REFRESH_INTERVAL, rebuild=None):
+        self.datasets = datasets
+        self.interval = interval
+        self.rebuild = rebuild
+        self._wakeup = threading.Event()
+        self._forced = set()
+        self._thread = None
+        self._lock = threading.Lock()
+        for data in datasets:
+            data.scheduler = self
+
+    def start(self):
+        '''Start the refresh thread unless it is already running.'''
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='lcd-refresh', daemon=True)
+                self._thread.start()
+
+    def trigger(self, force=None):
+        '''Wake up the refresh thread, optionally forcing a reload of dataset <force>; returns immediately.'''
+        if force is not None:
+            with self._lock:
+                self._forced.add(force)
+        self._wakeup.set()
+        self.start()
+
+    def _secs_to_next_refresh(self, failed):
+        if failed:
+            return RETRY_INTERVAL
+        oldest = min(data.last_update_time for data in self.datasets)
+        return max(oldest + self.interval - time(), 1)
+
+    def _refresh_all(self, forced):
+        '''Reload the datasets due or in <forced>, returns True if a reload failed.'''
+        if self.rebuild is not None:
+            try:
+                self.rebuild.rebuild(forced)
+            except Exception as e:          # keep serving the previous snapshots
+                print("data reload failed:", e)
+                return True
+            return False
+        due = [data for data in self.datasets if data.snapshot is None or data.is_dirty(self.interval) or data in forced]
+        with ThreadPoolExecutor(max(len(due), 1)) as threads:
+            pulls = [(data, threads.submit(self._pull, data)) for data in due]
+        failed = False
+        for data, pull in pulls:
+            try:
+                data.refresh(data in forced, pull.result())
+            except Exception as e:          # keep serving the previous snapshot
+                print("data reload failed:", data.source.location, e)
+                failed = True
+        return failed
+
+    def _pull(self, data):
+        '''Returns the result of fetching the source of <data>, None if its intact local copy is loaded first.'''
+        if data.snapshot is None and data.source.local_copy_time() is not None:
+            return None
+        with timed('download'):
+            return data.source.fetch()
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                forced, self._forced = self._forced, set()
+            failed = self._refresh_all(forced)
+            self._wakeup.wait(self._secs_to_next_refresh(failed))
+
+scheduler = RefreshScheduler([coviddata_confirmed, coviddata_deaths, coviddata_recovered, coviddata_confirmed_us, coviddata_deaths_us])
+if PARALLEL_REBUILD:
+    scheduler.rebuild = ParallelRebuild(scheduler.datasets, REFRESH_INTERVAL, consistent=[coviddata_confirmed, coviddata_deaths])
+
+if SNAPSHOT_FILE:
+    snapshot_file = SnapshotFile(SNAPSHOT_FILE)
+    for data in scheduler.datasets:
+        data.snapshot_file = snapshot_file
+elif WARM_SNAPSHOT and os.path.exists(WARM_SNAPSHOT):
+    warm_snapshots = read_snapshot_file(WARM_SNAPSHOT)
+    for data in scheduler.datasets:
+        data.snapshot = warm_snapshots.get(data.name)
+        data.warm = data.snapshot is not None
+        if not data.warm:
+            print("no snapshot of %s in %s" % (data.name, WARM_SNAPSHOT))
+
+def build_snapshot(path):
+    '''Load the current data and write it to <path>, to be served from the start with LCD_WARM_SNAPSHOT.'''
+    for data in scheduler.datasets:
+        data.refresh()
+    write_snapshot_file(path, {data.name: data.snapshot for data in scheduler.datasets})
+    print("snapshot written to", path)
 
 app = Flask(__name__)
+datasets = {'confirmed': coviddata_confirmed, 'deaths': coviddata_deaths, 'recovered': coviddata_recovered,
+            'confirmed_us': coviddata_confirmed_us, 'deaths_us': coviddata_deaths_us}
+app.register_blueprint(create_api(datasets))
+page_cache = LRUCache(PAGE_CACHE_SIZE, PAGE_CACHE_BYTES, lambda page: page.nbytes)
+
+caches = {'page': page_cache}
+caches.update({'query_' + name: data.query_cache for name, data in datasets.items()})
+caches.update({'archive_' + name: data.archived_snapshots for name, data in datasets.items() if data.archive is not None})
+app.add_url_rule('/metrics', 'metrics', metrics_view(datasets, caches))
+if METRICS_ENABLED:
+    app.after_request(add_server_timing)
+
+@app.template_filter('trend')
+def format_trend(trend):
+    '''Format trend column for display; NaN means that there is no trend at this time.'''
+    return "n/a at this time" if isnan(trend) else str(int(trend))
+
+def cached_page(data):
+    '''
+    Serve the pages rendered by a view of <data> from page_cache.
+    <data> is a CovidData or a function returning the CovidData of the request (None: 404).
+
+    A page is a pure function of the request path, the normalized query params
+    and the data snapshot, so these make up the cache key and the strong ETag.
+    The params are parsed like the views do, so e.g. days=080 and days=80 share a page.
+    Requests with a matching If-None-Match header are answered with 304.
+    Pages of the as_of url param depend on the archived snapshot instead.
+    Large pages (see render_page()) are streamed while rendered and not cached.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper():
+            force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
+            dataset = data() if callable(data) else data
+            if dataset is None:
+                abort(404)
+            dataset._check_for_update(force_reload)
+            snapshot = dataset.snapshot
+            as_of = as_of_arg()
+            if as_of is not None:
+                snapshot = dataset.archived_snapshot(as_of)
+                if snapshot is None:
+                    abort(404, "no data archived as of " + request.args['as_of'])
+            params = tuple((name, request.args.get(name, type=kind)) for name, kind in PAGE_PARAMS.items())
+            key = (request.path, params, snapshot.version, snapshot.last_update_time)
+            page = page_cache.get(key)
+            if page is None:
+                tag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20]
+                with timed('render'):
+                    body = view()
+                if not isinstance(body, str):
+                    encoding = 'gzip' if 'gzip' in request.accept_encodings else 'identity'
+                    response = Response(stream_encoded(body, encoding), mimetype='text/html')
+                    if encoding != 'identity':
+                        response.headers['Content-Encoding'] = encoding
+                    response.headers['Vary'] = 'Accept-Encoding'
+                    return response
+                with timed('compress'):
+                    page = CompressedPage(body, tag)
+                page_cache.put(key, page)
+            return page_response(page)
+        return wrapper
+    return decorator
+
+def page_response(page, cache_control='no-cache'):
+    '''Returns response with the best encoding of CompressedPage <page>, 304 if the client has it already.'''
+    encoding = page.select_encoding(request.accept_encodings)
+    if request.if_none_match.contains_weak(page.etag(encoding)):
+        response = Response(status=304)
+    else:
+        response = Response(page.body(encoding), mimetype='text/html')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(page.etag(encoding))
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def page_args():
+    '''Returns the limit (0: all rows) and offset url params.'''
+    return request.args.get('limit', default=0, type=int), request.args.get('offset', default=0, type=int)
+
+def region_arg(default=""):
+    '''Returns the region url param, e.g. 'US/New York' to show New York and its counties.'''
+    return request.args.get('region', default=default, type=str)
+
+def as_of_arg():
+    '''Returns the as_of url param as timestamp (None if not given), e.g. '2020-04-01' to show the data of that day.'''
+    text = request.args.get('as_of', default="", type=str)
+    if text == "":
+        return None
+    try:
+        return parse_as_of(text)
+    except ValueError:
+        abort(400, "as_of must be an ISO date like 2020-04-01 or 2020-04-01T12:00")
+
+def update_time_text(data):
+    '''Returns the time the data shown was loaded; for the as_of url param the time it was archived.'''
+    as_of = as_of_arg()
+    if as_of is None:
+        return strftime('%a %H:%M', localtime(data.last_update_time))
+    return strftime('%d.%m.%y %H:%M', localtime(data.archived_snapshot(as_of).last_update_time)) + " (archived)"
+
+def render_page(title, absval, relval, context):
+    '''Render the lcd template; rows returned as generators by compute_*_values() are streamed.'''
+    if isinstance(absval, list):
+        return render_template('lcd.html', title=title, rows=zip(absval, relval), context=context)
+    return stream_template('lcd.html', title=title, rows=zip(absval, relval), context=context)
 
 @app.route("/confirmed/")
+@cached_page(coviddata_confirmed)
 def confirmed():
     days = request.args.get('days', default=7, type=int)
     cases = request.args.get('cases', default=32000, type=int)
     country = request.args.get('country', default="", type=str)
     force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
-    absval, relval, dat_start, dat_end = coviddata_confirmed.compute_abs_values(days, cases, country, force_reload)
+    absval, relval, dat_start, dat_end = coviddata_confirmed.compute_abs_values(days, cases, country, force_reload, *page_args(), region_arg(), as_of_arg())
     header = "Total Confirmed Cases (" + dat_start + ' - ' + dat_end + ').'
-    context = ["confirmed", header, days, cases, "cases", country, __version__, strftime('%a %H:%M', localtime(coviddata_confirmed.last_update_time))]
-    return render_template('lcd.html', title='confirmed', absval=absval, relval=relval, context=context)
+    context = ["confirmed", header, days, cases, "cases", country, __version__, update_time_text(coviddata_confirmed), region_arg()]
+    return render_page('confirmed', absval, relval, context)
 
 @app.route("/confirmed_dif/")
+@cached_page(coviddata_confirmed)
 def confirmed_dif():
     days = request.args.get('days', default=7, type=int)
     cases = request.args.get('cases', default=32000, type=int)
     country = request.args.get('country', default="", type=str)
     force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
-    absval, relval, dat_start, dat_end = coviddata_confirmed.compute_dif_values(days, cases, country, force_reload)
+    absval, relval, dat_start, dat_end = coviddata_confirmed.compute_dif_values(days, cases, country, force_reload, *page_args(), region_arg(), as_of_arg())
     header = "Daily New Cases (" + dat_start + ' - ' + dat_end + ').'
-    context = ["confirmed_dif", header, days, cases, "cases", country, __version__, strftime('%a %H:%M', localtime(coviddata_confirmed.last_update_time))]
-    return render_template('lcd.html', title='confirmed (differential)', absval=absval, relval=relval, context=context)
+    context = ["confirmed_dif", header, days, cases, "cases", country, __version__, update_time_text(coviddata_confirmed), region_arg()]
+    return render_page('confirmed (differential)', absval, relval, context)
 
 @app.route("/deaths/")
+@cached_page(coviddata_deaths)
 def deaths():
     days = request.args.get('days', default=7, type=int)
     cases = request.args.get('cases', default=1000, type=int)
     country = request.args.get('country', default="", type=str)
     force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
-    absval, relval, dat_start, dat_end = coviddata_deaths.compute_abs_values(days, cases, country, force_reload)
+    absval, relval, dat_start, dat_end = coviddata_deaths.compute_abs_values(days, cases, country, force_reload, *page_args(), region_arg(), as_of_arg())
     header = "Total Deaths (" + dat_start + ' - ' + dat_end + ').'
-    context = ["deaths", header, days, cases, "deaths", country, __version__, strftime('%a %H:%M', localtime(coviddata_deaths.last_update_time))]
-    return render_template('lcd.html', title='deaths', absval=absval, relval=relval, context=context)
+    context = ["deaths", header, days, cases, "deaths", country, __version__, update_time_text(coviddata_deaths), region_arg()]
+    return render_page('deaths', absval, relval, context)
 
 @app.route("/deaths_dif/")
+@cached_page(coviddata_deaths)
 def deaths_dif():
     days = request.args.get('days', default=7, type=int)
     cases = request.args.get('cases', default=1000, type=int)
     country = request.args.get('country', default="", type=str)
     force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
-    absval, relval, dat_start, dat_end = coviddata_deaths.compute_dif_values(days, cases, country, force_reload)
+    absval, relval, dat_start, dat_end = coviddata_deaths.compute_dif_values(days, cases, country, force_reload, *page_args(), region_arg(), as_of_arg())
     header = "Daily New Deaths (" + dat_start + ' - ' + dat_end + ').'
-    context = ["deaths_dif", header, days, cases, "deaths", country, __version__, strftime('%a %H:%M', localtime(coviddata_deaths.last_update_time))]
-    return render_template('lcd.html', title='deaths (differential)', absval=absval, relval=relval, context=context)
+    context = ["deaths_dif", header, days, cases, "deaths", country, __version__, update_time_text(coviddata_deaths), region_arg()]
+    return render_page('deaths (differential)', absval, relval, context)
 
 @app.route("/recovered/")
+@cached_page(coviddata_recovered)
 def recovered():
     days = request.args.get('days', default=7, type=int)
     cases = request.args.get('cases', default=1000, type=int)
     country = request.args.get('country', default="", type=str)
     force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
-    absval, relval, dat_start, dat_end = coviddata_recovered.compute_abs_values(days, cases, country, force_reload)
+    absval, relval, dat_start, dat_end = coviddata_recovered.compute_abs_values(days, cases, country, force_reload, *page_args(), region_arg(), as_of_arg())
     header = "Total Recovered (" + dat_start + ' - ' + dat_end + ').'
-    context = ["recovered", header, days, cases, "recovered", country, __version__, strftime('%a %H:%M', localtime(coviddata_recovered.last_update_time))]
-    return render_template('lcd.html', title='recovered', absval=absval, relval=relval, context=context)
+    context = ["recovered", header, days, cases, "recovered", country, __version__, update_time_text(coviddata_recovered), region_arg()]
+    return render_page('recovered', absval, relval, context)
 
 @app.route("/recovered_dif/")
+@cached_page(coviddata_recovered)
 def recovered_dif():
     days = request.args.get('days', default=7, type=int)
     cases = request.args.get('cases', default=1000, type=int)
     country = request.args.get('country', default="", type=str)
     force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
-    absval, relval, dat_start, dat_end = coviddata_recovered.compute_dif_values(days, cases, country, force_reload)
+    absval, relval, dat_start, dat_end = coviddata_recovered.compute_dif_values(days, cases, country, force_reload, *page_args(), region_arg(), as_of_arg())
     header = "Daily New Recovered (" + dat_start + ' - ' + dat_end + ').'
-    context = ["recovered_dif", header, days, cases, "recovered", country, __version__, strftime('%a %H:%M', localtime(coviddata_recovered.last_update_time))]
-    return render_template('lcd.html', title='recovered (differential)', absval=absval, relval=relval, context=context)
+    context = ["recovered_dif", header, days, cases, "recovered", country, __version__, update_time_text(coviddata_recovered), region_arg()]
+    return render_page('recovered (differential)', absval, relval, context)
+
+@app.route("/confirmed_incidence/")
+@cached_page(coviddata_confirmed)
+def confirmed_incidence():
+    days = request.args.get('days', default=7, type=int)
+    cases = request.args.get('cases', default=32000, type=int)
+    country = request.args.get('country', default="", type=str)
+    force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
+    absval, relval, dat_start, dat_end = coviddata_confirmed.compute_metric_values('incidence7', days, cases, country, force_reload, *page_args(), region_arg(), as_of_arg())
+    header = "7-Day Incidence per 100k Residents (" + dat_start + ' - ' + dat_end + ').'
+    context = ["confirmed_incidence", header, days, cases, "cases", country, __version__, update_time_text(coviddata_confirmed), region_arg()]
+    return render_page('confirmed (7-day incidence)', absval, relval, context)
+
+@app.route("/confirmed_us/")
+@cached_page(coviddata_confirmed_us)
+def confirmed_us():
+    days = request.args.get('days', default=7, type=int)
+    cases = request.args.get('cases', default=1000, type=int)
+    country = request.args.get('country', default="", type=str)
+    region = region_arg('US')
+    force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
+    absval, relval, dat_start, dat_end = coviddata_confirmed_us.compute_abs_values(days, cases, country, force_reload, *page_args(), region, as_of_arg())
+    header = "Total Confirmed Cases in the US (" + dat_start + ' - ' + dat_end + ').'
+    context = ["confirmed_us", header, days, cases, "cases", country, __version__, update_time_text(coviddata_confirmed_us), region]
+    return render_page('confirmed (US)', absval, relval, context)
+
+@app.route("/deaths_us/")
+@cached_page(coviddata_deaths_us)
+def deaths_us():
+    days = request.args.get('days', default=7, type=int)
+    cases = request.args.get('cases', default=100, type=int)
+    country = request.args.get('country', default="", type=str)
+    region = region_arg('US')
+    force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
+    absval, relval, dat_start, dat_end = coviddata_deaths_us.compute_abs_values(days, cases, country, force_reload, *page_args(), region, as_of_arg())
+    header = "Total Deaths in the US (" + dat_start + ' - ' + dat_end + ').'
+    context = ["deaths_us", header, days, cases, "deaths", country, __version__, update_time_text(coviddata_deaths_us), region]
+    return render_page('deaths (US)', absval, relval, context)
+
+def compare_dataset():
+    '''Returns the CovidData selected by the metric url param of /compare, None if unknown.'''
+    return datasets.get(request.args.get('metric', default="confirmed", type=str))
+
+@app.route("/compare")
+@cached_page(compare_dataset)
+def compare():
+    metric = request.args.get('metric', default="confirmed", type=str)
+    view = request.args.get('view', default="abs", type=str)
+    days = request.args.get('days', default=28, type=int)
+    data = compare_dataset()
+    if view not in ('abs', 'dif') + tuple(METRICS):
+        abort(400, "view must be one of abs, dif, " + ", ".join(METRICS))
+    countries = request.args.get('countries', default="", type=str)
+    force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
+    absval, relval, dat_start, dat_end = data.compute_compare_values(view, countries, days, force_reload, *page_args(), as_of_arg())
+    regions = data.compare_view(view, countries, days, as_of=as_of_arg()).table.regions
+    header = "Comparison of " + metric + ("" if view == 'abs' else " (" + view + ")") + " (" + dat_start + ' - ' + dat_end + ').'
+    context = ["compare", header, days, 1000, metric, ", ".join(regions), __version__, update_time_text(data), ""]
+    return render_page('compare ' + metric, absval, relval, context)
+
+# Pages of the client rendering mode, see templates/lcd_client.html:
+# page -> (metric, view, header, default cases, default region, unit, menu entry).
+CLIENT_PAGES = {
+    'confirmed': ('confirmed', 'abs', "Total Confirmed Cases", 32000, "", "cases", "Total Confirmed Cases"),
+    'confirmed_dif': ('confirmed', 'dif', "Daily New Cases", 32000, "", "cases", "Daily New Cases"),
+    'confirmed_incidence': ('confirmed', 'incidence7', "7-Day Incidence per 100k Residents", 32000, "", "cases", "7-Day Incidence"),
+    'deaths': ('deaths', 'abs', "Total Deaths", 1000, "", "deaths", "Total Deaths"),
+    'deaths_dif': ('deaths', 'dif', "Daily New Deaths", 1000, "", "deaths", "Daily New Deaths"),
+    'recovered': ('recovered', 'abs', "Total Recovered", 1000, "", "recovered", ""),
+    'recovered_dif': ('recovered', 'dif', "Daily New Recovered", 1000, "", "recovered", ""),
+    'confirmed_us': ('confirmed_us', 'abs', "Total Confirmed Cases in the US", 1000, "US", "cases", "US Confirmed Cases"),
+    'deaths_us': ('deaths_us', 'abs', "Total Deaths in the US", 100, "US", "deaths", "US Deaths"),
+    'av_growth_rate': ('confirmed', 'agr', "", 1000, "", "confirmed cases", "Average growth rate in the last seven days"),
+    'compare': ('confirmed', 'abs', "", 1000, "", "cases", ""),
+}
+
+def client_shell():
+    '''Returns the page of the client rendering mode as CompressedPage, rendered once: it is the same for every view.'''
+    page = page_cache.get(('client',))
+    if page is None:
+        menu = [(name, spec[6]) for name, spec in CLIENT_PAGES.items() if spec[6]]
+        body = render_template('lcd_client.html', pages=CLIENT_PAGES, menu=menu, version=__version__)
+        page = CompressedPage(body, hashlib.sha1(body.encode('utf-8')).hexdigest()[:20])
+        page_cache.put(('client',), page)
+    return page
+
+@app.route("/client/<page>/")
+def client(page):
+    '''
+    Client rendering mode: a page without data, kept by browsers for CLIENT_SHELL_MAX_AGE,
+    which fetches the data of the view from the data API and draws the bars itself.
+    '''
+    if page not in CLIENT_PAGES:
+        abort(404)
+    return page_response(client_shell(), 'public, max-age=%d' % CLIENT_SHELL_MAX_AGE)
 
 @app.route("/av_growth_rate/")
+@cached_page(coviddata_confirmed)
 def average_percentage_increase():
     days = request.args.get('days', default=7, type=int)
     cases = request.args.get('cases', default=1000, type=int)
     force_reload = True if request.args.get('force', default="", type=str) == 'yes' else False
-    absval, relval, dat_start, dat_end = coviddata_confirmed.compute_agr_values(cases, force_reload)
+    absval, relval, dat_start, dat_end = coviddata_confirmed.compute_agr_values(cases, force_reload, *page_args(), region_arg(), as_of_arg())
     header = ""
-    context = ["av_growth_rate", header, days, cases, "", "", __version__, strftime('%a %H:%M', localtime(coviddata_confirmed.last_update_time))]
-    return render_template('lcd.html', title='Average growth rate in the last seven days', absval=absval, relval=relval, context=context)
+    context = ["av_growth_rate", header, days, cases, "", "", __version__, update_time_text(coviddata_confirmed), region_arg()]
+    return render_page('Average growth rate in the last seven days', absval, relval, context)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', debug=True)
\ No newline at end of file
+    if sys.argv[1:2] == ['build-snapshot']:
+        if len(sys.argv) != 3:
+            sys.exit("usage: python -m lcd build-snapshot <snapshot file>")
+        build_snapshot(sys.argv[2])
+    else:
+        app.run(host='0.0.0.0', debug=True)
\ No newline at end of file
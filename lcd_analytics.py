@@ -0,0 +1,86 @@
+#
+# Rolling window analytics over the full history of a table.
+#
+# Every series is computed at most once per snapshot, for all regions and all
+# dates in one go, so views just slice the precomputed matrices. Rolling sums
+# need no window loop at all: the tables hold cumulative numbers, so the sum of
+# the new cases of the last N days is the difference of two columns.
+#
+
+import numpy
+import threading
+
+# metric name -> (Analytics method, window in days); the names are also view names
+METRICS = {
+    'mean7': ('rolling_mean', 7),           # average daily new cases of the last 7 days
+    'incidence7': ('incidence', 7),         # new cases of the last 7 days per 100k residents
+    'growth7': ('growth_rate', 7),          # compound daily growth rate of the last 7 days in %
+    'doubling7': ('doubling_time', 7),      # doubling time in days at that growth rate
+}
+
+class Analytics:
+    '''
+    Derived daily series (regions x dates) of a SeriesTable of cumulative numbers, rows like the table.
+    Values a window does not fit into (the first dates) and undefined values are NaN.
+    '''
+    def __init__(self, table):
+        self.table = table
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key, compute):
+        series = self._series.get(key)
+        if series is None:
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                series = compute()
+            series.setflags(write=False)
+            with self._lock:
+                series = self._series.setdefault(key, series)
+        return series
+
+    def _values(self):
+        return self._cached('values', lambda: self.table.values[self.table.value_rows].astype('float64'))
+
+    def _shifted(self, window):
+        '''Returns the values <window> days before every date.'''
+        def compute():
+            values = self._values()
+            shifted = numpy.full(values.shape, numpy.nan)
+            shifted[:, window:] = values[:, :-window]
+            return shifted
+        return self._cached(('shifted', window), compute)
+
+    def rolling_sum(self, window):
+        '''New cases within the last <window> days.'''
+        return self._cached(('rolling_sum', window), lambda: self._values() - self._shifted(window))
+
+    def rolling_mean(self, window):
+        '''Average daily new cases within the last <window> days.'''
+        return self._cached(('rolling_mean', window), lambda: self.rolling_sum(window) / window)
+
+    def incidence(self, window):
+        '''New cases within the last <window> days per 100k residents, NaN if the population is unknown.'''
+        def compute():
+            residents_100k = numpy.where(self.table.population > 0, self.table.population * 10, numpy.nan)
+            return self.rolling_sum(window) / residents_100k[:, None]
+        return self._cached(('incidence', window), compute)
+
+    def growth_rate(self, window):
+        '''Compound daily growth rate in % within the last <window> days, NaN without cases before.'''
+        def compute():
+            before = self._shifted(window)
+            ratio = numpy.where(before > 0, self._values() / before, numpy.nan)
+            return (ratio ** (1 / window) - 1) * 100
+        return self._cached(('growth_rate', window), compute)
+
+    def doubling_time(self, window):
+        '''Days to double the cases at the growth rate of the last <window> days, NaN if not growing.'''
+        def compute():
+            rate = self.growth_rate(window)
+            return numpy.where(rate > 0, numpy.log(2) / numpy.log1p(rate / 100), numpy.nan)
+        return self._cached(('doubling_time', window), compute)
+
+    def metric(self, name):
+        '''Returns the series of metric <name> (see METRICS) and its window.'''
+        method, window = METRICS[name]
+        return getattr(self, method)(window), window
@@ -0,0 +1,183 @@
+#
+# Data API next to the HTML views.
+#
+# GET /api/v1/<metric>/<view>?days=7&cases=1000&country=&region=&limit=0&offset=0&as_of=&format=json
+#
+# metric: confirmed, deaths, recovered, confirmed_us or deaths_us; view: abs, dif, agr or one
+# of the rolling window metrics in lcd_analytics.METRICS (e.g. incidence7).
+# region (e.g. 'China' or 'US/New York') selects a region and its subregions instead of all countries.
+# countries (e.g. 'Germany,France,[Europe]') selects just these regions, in this order (not with agr).
+# as_of (e.g. '2020-04-01' or '2020-04-01T12:00') serves the data as archived at that time (requires LCD_ARCHIVE_DIR).
+# The data is the same as shown by the HTML views, but column oriented:
+# one array per metadata column and one array per value column (date or growth rate).
+# limit (0: all) and offset select a page of the rows.
+# format=arrow returns an Arrow IPC stream instead of json (requires pyarrow).
+# value_max in the header is the largest value of the view (of the first column for agr), the 100 % of its bars.
+# NaN and infinite values (e.g. the growth rate of a region growing from 0) are null.
+#
+# Responses carry an ETag of the request and the data version, so clients (e.g. the client rendering
+# mode, templates/lcd_client.html) revalidate them and only download the data again after a reload.
+#
+
+import json
+import numpy
+import hashlib
+
+from flask import Blueprint, Response, abort, request
+from lcd_cache import stream_encoded
+from lcd_store import page_bounds
+from lcd_analytics import METRICS
+from lcd_archive import parse_as_of
+
+pyarrow = None              # imported on the first Arrow request, see _import_pyarrow()
+
+VIEWS = ('abs', 'dif', 'agr') + tuple(METRICS)
+DEFAULT_CASES = {'confirmed': 32000, 'deaths': 1000, 'recovered': 1000, 'confirmed_us': 1000, 'deaths_us': 100, 'agr': 1000}
+DEFAULT_REGIONS = {'confirmed_us': 'US', 'deaths_us': 'US'}
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+ARROW_BATCH_ROWS = 1024
+
+def _import_pyarrow():
+    '''Returns True if pyarrow is available; imported on first use so it does not slow down startup.'''
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.ipc
+        except ImportError:
+            pyarrow = False
+    return pyarrow is not False
+
+def _json_array(array):
+    '''Serialize numpy array as json list; NaN and infinite values (e.g. growth from 0) become null.'''
+    values = array.tolist()
+    if array.dtype.kind == 'f':
+        values = [value if finite else None for value, finite in zip(values, numpy.isfinite(array).tolist())]
+    return json.dumps(values)
+
+def _value_max(view_name, values):
+    '''Returns the largest finite value of <values> (of the first column for agr), None if there is none.'''
+    values = values[:, :1] if view_name == 'agr' else values
+    values = values[numpy.isfinite(values)]
+    if values.size == 0:
+        return None
+    return float(values.max())
+
+def _json_chunks(header, view):
+    '''Generate the json document of <view> column by column.'''
+    table, rows = view.table, view.rows
+    yield json.dumps(header)[:-1]
+    yield ', "columns": ' + json.dumps(list(view.columns))
+    yield ', "region": ' + json.dumps([table.regions[row] for row in rows.tolist()])
+    for name in ('population', 'residents_per_case', 'trend'):
+        yield ', "%s": %s' % (name, _json_array(getattr(table, name)[rows]))
+    yield ', "values": ['
+    for col in range(view.values.shape[1]):
+        yield (', ' if col else '') + _json_array(view.values[:, col])
+    yield ']}'
+
+class _ChunkSink:
+    '''Minimal writable file collecting the bytes written by the Arrow stream writer.'''
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+def _arrow_chunks(header, view):
+    '''Generate an Arrow IPC stream of <view>, one record batch per ARROW_BATCH_ROWS rows.'''
+    table, rows = view.table, view.rows
+    names = ['region', 'population', 'residents_per_case', 'trend'] + list(view.columns)
+    metadata = {key: str(value) for key, value in header.items()}
+    sink = _ChunkSink()
+    with pyarrow.PythonFile(sink, mode='w') as stream:
+        writer = None
+        for start in range(0, max(len(rows), 1), ARROW_BATCH_ROWS):
+            batch_rows = rows[start:start + ARROW_BATCH_ROWS]
+            values = view.values[start:start + ARROW_BATCH_ROWS]
+            arrays = [pyarrow.array([table.regions[row] for row in batch_rows.tolist()], pyarrow.string()),
+                      pyarrow.array(table.population[batch_rows]),
+                      pyarrow.array(table.residents_per_case[batch_rows]),
+                      pyarrow.array(table.trend[batch_rows], from_pandas=True)]
+            arrays += [pyarrow.array(values[:, col], from_pandas=True) for col in range(values.shape[1])]
+            batch = pyarrow.RecordBatch.from_arrays(arrays, names=names)
+            if writer is None:
+                writer = pyarrow.ipc.new_stream(stream, batch.schema.with_metadata(metadata))
+            writer.write_batch(batch)
+            yield sink.take()
+        writer.close()
+    yield sink.take()
+
+def create_api(datasets):
+    '''Returns blueprint serving the data of <datasets> (dict metric -> CovidData).'''
+    api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+    @api.route("/<metric>/<view>")
+    def data(metric, view):
+        if metric not in datasets or view not in VIEWS:
+            abort(404)
+        days = request.args.get('days', default=7, type=int)
+        cases = request.args.get('cases', default=DEFAULT_CASES['agr' if view == 'agr' else metric], type=int)
+        country = request.args.get('country', default="", type=str)
+        region = request.args.get('region', default=DEFAULT_REGIONS.get(metric, ""), type=str)
+        limit = request.args.get('limit', default=0, type=int)
+        offset = request.args.get('offset', default=0, type=int)
+        output_format = request.args.get('format', default="json", type=str)
+        if output_format not in ('json', 'arrow'):
+            abort(400, "format must be 'json' or 'arrow'")
+        if output_format == 'arrow' and not _import_pyarrow():
+            abort(406, "Arrow output requires pyarrow")
+        countries = request.args.get('countries', default="", type=str)
+        if countries and view == 'agr':
+            abort(400, "countries can't be given for view agr")
+        as_of = request.args.get('as_of', default="", type=str)
+        try:
+            as_of = parse_as_of(as_of) if as_of else None
+        except ValueError:
+            abort(400, "as_of must be an ISO date like 2020-04-01 or 2020-04-01T12:00")
+        data = datasets[metric]
+        if as_of is not None and data.archived_snapshot(as_of) is None:
+            abort(404, "no data archived as of " + request.args['as_of'])
+        data._check_for_update()
+        snapshot = data._served_snapshot(as_of)      # taken first: a reload in between changes the ETag, never the other way round
+        if countries:
+            table_view = data.compare_view(view, countries, days, as_of=as_of)
+        else:
+            table_view = data.compute_view(view, days, cases, country, region=region, as_of=as_of)
+        encoding = 'gzip' if output_format == 'json' and 'gzip' in request.accept_encodings else 'identity'
+        etag = hashlib.sha1(repr((request.full_path, snapshot.version, snapshot.last_update_time)).encode('utf-8')).hexdigest()[:20]
+        etag += '' if encoding == 'identity' else '-' + encoding
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        start, stop = page_bounds(len(table_view.rows), limit, offset)
+        value_max = _value_max(view, table_view.values)
+        table_view = table_view._replace(rows=table_view.rows[start:stop], values=table_view.values[start:stop])
+        header = {'metric': metric, 'view': view, 'version': snapshot.version, 'last_update_time': snapshot.last_update_time,
+                  'dat_start': table_view.dat_start, 'dat_end': table_view.dat_end, 'value_max': value_max}
+        if output_format == 'arrow':
+            response = Response(_arrow_chunks(header, table_view), mimetype=ARROW_MIMETYPE)
+        else:
+            response = Response(stream_encoded(_json_chunks(header, table_view), encoding), mimetype='application/json')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+            response.headers['Vary'] = 'Accept-Encoding'
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    return api
@@ -0,0 +1,231 @@
+#
+# Append-only archive of the versions of a time series file.
+#
+# Every reload replaces the data file and JHU now and then revises past values,
+# so the archive keeps what the dashboard did show: the values of all nodes of
+# the region tree of every version. Only every KEYFRAME_INTERVAL-th version is
+# stored in full (a keyframe), the others as delta to their predecessor: the
+# appended date columns and the cells of past dates that were revised. Daily
+# numbers compress much better than cumulative ones, so the date columns are
+# stored as differences. A version is rebuilt from the keyframe before it and
+# the deltas up to it; the rebuilt versions are kept in an LRU cache.
+#
+# Files: <path>.lcda holds the records, each zlib compressed: header length
+# (uint32 little endian), json header (dates, names of the tree nodes, dtype
+# and shape of the arrays) and the raw arrays. <path>.lcdi is the index: magic
+# followed by one INDEX_ENTRY (archive time, offset, length, keyframe) per
+# version. A record is written before its index entry, so readers (e.g. other
+# worker processes) never see a partial one.
+#
+
+import os
+import json
+import zlib
+import numpy
+import struct
+import bisect
+import threading
+import contextlib
+
+from collections import namedtuple
+from datetime import datetime, time as day_time
+from lcd_cache import LRUCache
+from lcd_hierarchy import RegionTree
+
+try:
+    import fcntl
+except ImportError:         # no file locks (Windows): only one process may append then
+    fcntl = None
+
+MAGIC = b'LCDARCH1'
+INDEX_ENTRY = struct.Struct('<dQQ?')
+KEYFRAME_INTERVAL = 30      # versions stored as delta between two keyframes + 1
+CACHE_SIZE = 8              # rebuilt versions kept per archive
+
+# Version <version> of the archive: int32 <values> (nodes of <tree> x <dates>) as archived at <archive_time>.
+ArchivedVersion = namedtuple('ArchivedVersion', ['version', 'archive_time', 'tree', 'dates', 'values'])
+
+def parse_as_of(text):
+    '''
+    Returns the timestamp of ISO date <text> in local time, the end of the day for a date
+    ('2020-04-01') or the given time ('2020-04-01T12:00'). Raises ValueError if invalid.
+    '''
+    moment = datetime.fromisoformat(text)
+    if len(text) <= len('2020-04-01'):
+        moment = datetime.combine(moment.date(), day_time.max)
+    return moment.timestamp()
+
+def _encode(header, arrays):
+    '''Returns the compressed record of json <header> and dict <arrays> (name -> numpy array).'''
+    header = dict(header, arrays={name: {'dtype': a.dtype.str, 'shape': list(a.shape)} for name, a in arrays.items()})
+    header_bytes = json.dumps(header).encode('utf-8')
+    chunks = [struct.pack('<I', len(header_bytes)), header_bytes]
+    chunks += [numpy.ascontiguousarray(a).tobytes() for a in arrays.values()]
+    return zlib.compress(b''.join(chunks), 6)
+
+def _decode(record):
+    '''Returns json header and dict of (read-only) arrays of a record written by _encode().'''
+    data = zlib.decompress(record)
+    length, = struct.unpack('<I', data[:4])
+    header = json.loads(data[4:4 + length].decode('utf-8'))
+    arrays, offset = {}, 4 + length
+    for name, spec in header['arrays'].items():
+        dtype = numpy.dtype(spec['dtype'])
+        count = int(numpy.prod(spec['shape']))
+        arrays[name] = numpy.frombuffer(data, dtype, count, offset).reshape(spec['shape'])
+        offset += count * dtype.itemsize
+    return header, arrays
+
+def _same_tree(a, b):
+    return a.names == b.names and numpy.array_equal(a.parent, b.parent) and numpy.array_equal(a.level, b.level)
+
+class SnapshotArchive:
+    '''
+    Archive of the versions of one time series file, stored in <path>.lcda and <path>.lcdi.
+    Versions are numbered from 0 in the order they were appended; several processes
+    may read the archive while one of them appends.
+    '''
+    def __init__(self, path, keyframe_interval=KEYFRAME_INTERVAL, cache_size=CACHE_SIZE):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.cache = LRUCache(cache_size)
+        self._times = []
+        self._entries = []          # (offset, length, keyframe) of every version
+        self._index_size = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            self._read_index()
+            return len(self._entries)
+
+    def _read_index(self):
+        '''Read the index entries appended since the last call, possibly by another process.'''
+        try:
+            size = os.path.getsize(self.path + '.lcdi')
+        except OSError:
+            return
+        if size < self._index_size + INDEX_ENTRY.size:
+            return
+        with open(self.path + '.lcdi', 'rb') as f:
+            f.seek(self._index_size)
+            data = f.read(size - self._index_size)
+        if self._index_size == 0:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError("not an archive index: " + self.path + '.lcdi')
+            data, self._index_size = data[len(MAGIC):], len(MAGIC)
+        count = len(data) // INDEX_ENTRY.size
+        for archive_time, offset, length, keyframe in INDEX_ENTRY.iter_unpack(data[:count * INDEX_ENTRY.size]):
+            self._times.append(archive_time)
+            self._entries.append((offset, length, keyframe))
+        self._index_size += count * INDEX_ENTRY.size
+
+    def version_at(self, timestamp):
+        '''Returns the last version archived at or before <timestamp>, None if there is none.'''
+        with self._lock:
+            self._read_index()
+            version = bisect.bisect_right(self._times, timestamp) - 1
+        return version if version >= 0 else None
+
+    def _read_record(self, version):
+        offset, length, keyframe = self._entries[version]
+        with open(self.path + '.lcda', 'rb') as f:
+            f.seek(offset)
+            return _decode(f.read(length))
+
+    def _keyframe(self, version):
+        header, arrays = self._read_record(version)
+        tree = RegionTree(header['names'], arrays['parent'], arrays['level'])
+        values = numpy.cumsum(arrays['daily'], axis=1, dtype='int32')
+        return ArchivedVersion(version, self._times[version], tree, header['dates'], values)
+
+    def _apply_deltas(self, base, versions):
+        '''Returns ArchivedVersion <versions[-1]> rebuilt from <base> and the deltas <versions>, all in one matrix.'''
+        records = [self._read_record(version) for version in versions]
+        dates = base.dates + [date for header, arrays in records for date in header['dates']]
+        values = numpy.empty((len(base.tree), len(dates)), dtype='int32')
+        known = len(base.dates)
+        values[:, :known] = base.values
+        for header, arrays in records:
+            values[arrays['rows'], arrays['cols']] = arrays['cells']
+            added = len(header['dates'])
+            values[:, known:known + added] = values[:, known - 1:known] + numpy.cumsum(arrays['daily'], axis=1, dtype='int32')
+            known += added
+        return ArchivedVersion(versions[-1], self._times[versions[-1]], base.tree, dates, values)
+
+    def load(self, version):
+        '''
+        Returns ArchivedVersion <version>, rebuilt from the keyframe before it, or from the
+        closest cached version after that keyframe, and the deltas up to it.
+        '''
+        cached = self.cache.get(version)
+        if cached is not None:
+            return cached
+        with self._lock:
+            self._read_index()
+            if not 0 <= version < len(self._entries):
+                raise IndexError("version %d not in archive %s" % (version, self.path))
+            chain, archived = [version], None
+            while not self._entries[chain[-1]][2]:
+                archived = self.cache.get(chain[-1] - 1)
+                if archived is not None:
+                    break
+                chain.append(chain[-1] - 1)
+            chain.reverse()
+            if archived is None:
+                archived = self._keyframe(chain.pop(0))
+            if chain:
+                archived = self._apply_deltas(archived, chain)
+        self.cache.put(version, archived)
+        return archived
+
+    def _record(self, version, tree, dates, values):
+        '''Returns (record, keyframe) of <values> as successor of the last version, (None, False) if it is unchanged.'''
+        last = self.load(version - 1) if version else None
+        if (last is None or version % self.keyframe_interval == 0 or not _same_tree(last.tree, tree)
+                or not 0 < len(last.dates) <= len(dates) or dates[:len(last.dates)] != last.dates):
+            daily = numpy.diff(values, axis=1, prepend=0).astype('int32')
+            header = {'names': tree.names, 'dates': list(dates)}
+            return _encode(header, {'parent': tree.parent, 'level': tree.level, 'daily': daily}), True
+        known = len(last.dates)
+        rows, cols = numpy.nonzero(values[:, :known] != last.values)
+        if len(rows) == 0 and known == len(dates):
+            return None, False
+        arrays = {'rows': rows.astype('int32'), 'cols': cols.astype('int32'), 'cells': values[rows, cols].astype('int32'),
+                  'daily': numpy.diff(values[:, known - 1:], axis=1).astype('int32')}
+        return _encode({'dates': list(dates[known:])}, arrays), False
+
+    @contextlib.contextmanager
+    def _locked_files(self):
+        '''Opens the files for appending, locked against other processes appending to them.'''
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.lcdi', 'ab') as index, open(self.path + '.lcda', 'ab') as records:
+            if fcntl is not None:
+                fcntl.flock(index, fcntl.LOCK_EX)
+            yield index, records
+
+    def append(self, tree, dates, values, archive_time):
+        '''
+        Append the version <values> (nodes of <tree> x <dates>) archived at <archive_time>.
+        Returns its number or None if it equals the last version, e.g. if the same file is parsed again after a restart.
+        '''
+        values = numpy.asarray(values, dtype='int32')
+        with self._lock, self._locked_files() as (index, records):
+            self._read_index()
+            version = len(self._entries)
+            record, keyframe = self._record(version, tree, dates, values)
+            if record is None:
+                return None
+            archive_time = max([archive_time] + self._times[-1:])       # keep the index sorted by time
+            offset = records.seek(0, os.SEEK_END)
+            records.write(record)
+            records.flush()
+            if index.seek(0, os.SEEK_END) == 0:
+                index.write(MAGIC)
+            index.write(INDEX_ENTRY.pack(archive_time, offset, len(record), keyframe))
+            index.flush()
+            self._read_index()
+        self.cache.put(version, ArchivedVersion(version, archive_time, tree, list(dates), values.copy()))
+        return version
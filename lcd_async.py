@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+#
+# Async serving mode.
+#
+# The Flask app is wrapped into an ASGI application and the data refresh runs
+# as a task on the event loop: the sources are fetched concurrently and
+# parsed in an executor, while requests keep being answered from the current
+# snapshots. A refresh takes about as long as the slowest download instead of
+# the sum of all of them, and no request thread ever waits for the network.
+# Requests run on a pool of REQUEST_THREADS threads, so a slow one does not
+# hold up the others.
+#
+# usage: uvicorn lcd_async:app --host 0.0.0.0 --port 5000
+#        python lcd_async.py
+#
+# Requires asgiref >= 3.2 (and uvicorn or another ASGI server). aiohttp is optional,
+# without it the downloads run concurrently in executor threads.
+#
+
+import asyncio
+import sys
+import lcd
+
+from asgiref.wsgi import WsgiToAsgi
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from lcd_fetch import FETCH_TIMEOUT
+from lcd_metrics import timed
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+REQUEST_THREADS = 32        # max. number of requests served at the same time
+
+def _environ(scope, body):
+    '''Returns the WSGI environ of the request with ASGI <scope> and request body file <body>.'''
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope['http_version'],
+        'SERVER_NAME': scope['server'][0] if scope.get('server') else 'localhost',
+        'SERVER_PORT': str(scope['server'][1]) if scope.get('server') else '80',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if environ['PATH_INFO'].startswith(environ['SCRIPT_NAME']):
+        environ['PATH_INFO'] = environ['PATH_INFO'][len(environ['SCRIPT_NAME']):]
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            name = 'HTTP_' + name
+        value = value.decode('latin1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    '''
+    ASGI application serving WSGI application <wsgi_application> on up to <threads> threads.
+    WsgiToAsgi runs all requests on one shared thread, so every request would wait for the one before it.
+    '''
+    def __init__(self, wsgi_application, threads=REQUEST_THREADS):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='lcd-request')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError("unsupported scope: %s" % scope['type'])
+        loop = asyncio.get_running_loop()
+        with SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            await loop.run_in_executor(self.executor, self._run, scope, body,
+                                       lambda message: asyncio.run_coroutine_threadsafe(send(message), loop).result())
+
+    def _run(self, scope, body, send):
+        '''Runs the WSGI app on a thread of the pool, <send> passes the response messages to the event loop.'''
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and 'started' in response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['start'] = {'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                                 'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]}
+
+        output = self.wsgi_application(_environ(scope, body), start_response)
+        try:
+            for chunk in output:
+                if 'started' not in response:
+                    response['started'] = True
+                    send(response['start'])
+                if chunk:
+                    send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(output, 'close'):
+                output.close()
+        if 'started' not in response:
+            send(response['start'])
+        send({'type': 'http.response.body'})
+
+class AsyncRefresher(lcd.RefreshScheduler):
+    '''
+    Reload a set of CovidData instances on the event loop instead of a background thread.
+
+    Downloads of all due datasets run concurrently, each dataset is rebuilt in the
+    default executor as soon as its download is done. trigger() may be called from
+    any thread, e.g. the threads running the Flask views.
+    '''
+    def __init__(self, datasets, interval=lcd.REFRESH_INTERVAL):
+        super().__init__(datasets, interval)
+        self._loop = None
+        self._first_load = None
+        self._task = None
+
+    async def startup(self):
+        '''Load the data unless done yet and start the refresh task on the running loop.'''
+        if self._first_load is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._first_load = asyncio.ensure_future(self.refresh_all())
+        await self._first_load
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def start(self):
+        '''The refresh task is started with the application, see startup().'''
+
+    def trigger(self, force=None):
+        '''Wake up the refresh task, optionally forcing a reload of dataset <force>; returns immediately.'''
+        if force is not None:
+            with self._lock:
+                self._forced.add(force)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _refresh(self, session, data, force_reload):
+        '''Download <data> if due and rebuild its snapshot in the default executor.'''
+        loop = asyncio.get_running_loop()
+        if not (data.snapshot is None or data.is_dirty(self.interval) or force_reload):
+            return
+        if data.snapshot is None and data.source.local_copy_time() is not None:
+            changed = None          # first load parses the intact local copy without download
+        else:
+            with timed('download'):
+                changed = await data.source.fetch_async(session)
+        await loop.run_in_executor(None, data.refresh, force_reload, changed)
+
+    async def refresh_all(self):
+        '''Refresh all due datasets concurrently, returns False if any of them failed.'''
+        with self._lock:
+            forced, self._forced = self._forced, set()
+        if aiohttp is None:
+            results = await asyncio.gather(*[self._refresh(None, data, data in forced) for data in self.datasets],
+                                           return_exceptions=True)
+        else:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT)) as session:
+                results = await asyncio.gather(*[self._refresh(session, data, data in forced) for data in self.datasets],
+                                               return_exceptions=True)
+        failed = False
+        for data, result in zip(self.datasets, results):
+            if isinstance(result, Exception):       # keep serving the previous snapshot
+                print("data reload failed:", data.source.location, result)
+                failed = True
+        return not failed
+
+    async def _run(self):
+        failed = False
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._secs_to_next_refresh(failed))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            failed = not await self.refresh_all()
+
+class AsyncApp:
+    '''ASGI application serving the Flask app <wsgi_app>, with the lifespan of <refresher>.'''
+    def __init__(self, wsgi_app, refresher):
+        self.app = PooledWsgiToAsgi(wsgi_app)
+        self.refresher = refresher
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.refresher.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.refresher.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        await self.refresher.startup()      # servers without lifespan support
+        await self.app(scope, receive, send)
+
+refresher = AsyncRefresher(lcd.scheduler.datasets)
+app = AsyncApp(lcd.app, refresher)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the CovidData pipeline.
+#
+# usage: python lcd_bench.py columns [regions] [days] [--json]
+#        python lcd_bench.py parse [countries] [provinces] [days] [--json]
+#        python lcd_bench.py stages [countries] [provinces] [days] [--json]
+#        python lcd_bench.py load [secs per route] [client threads] [countries] [provinces] [days] [--json]
+#
+# columns: compares the vectorized column builders of CovidData with the former
+#          row by row implementations on a synthetic frame (default: 10000 regions x 1000 days).
+# parse:   compares parse time and peak memory of the streaming ingest with the former
+#          pandas path on a synthetic JHU file (default: 200 countries x 3 provinces x 1000 days).
+# stages:  times every stage from parsing a synthetic JHU file to the rendered and compressed page.
+# load:    serves the app with a local threaded WSGI server on synthetic files and reports
+#          throughput and p50/p99 latency of every route (default: 2 secs, 8 threads).
+#
+# With --json the results are written to stdout as json, so runs can be compared.
+#
+
+import os
+import sys
+import csv
+import json
+import logging
+import numpy
+import pandas
+import tempfile
+import threading
+import contextlib
+import tracemalloc
+import urllib.request
+
+from time import perf_counter
+from math import log10, isinf, isnan
+from flask import render_template
+from werkzeug.serving import make_server
+from lcd import CovidData
+from lcd_cache import CompressedPage
+from lcd_ingest import TimeSeriesIngest
+from lcd_archive import KEYFRAME_INTERVAL, SnapshotArchive
+from lcd_store import RankIndex, argsort_descending, make_snapshot
+from lcd_country_data import get_country_population, get_country_continent, country_data
+
+def synthetic_dates(days):
+    return ["%d/%d/%s" % (d.month, d.day, d.strftime('%y')) for d in pandas.date_range('2020-01-22', periods=days)]
+
+def synthetic_frame(regions=10000, days=1000, seed=0):
+    '''Returns a frame of cumulative cases (regions x days) sorted by last column, like CovidData.df_abs.'''
+    rng = numpy.random.default_rng(seed)
+    countries = list(country_data)
+    index = [countries[i] if i < len(countries) else "Region %d" % i for i in range(regions)]
+    columns = synthetic_dates(days)
+    values = rng.poisson(rng.uniform(0, 500, (regions, 1)), (regions, days)).cumsum(axis=1)
+    values[rng.random(regions) < 0.05] = 0                      # some regions without any case
+    df = pandas.DataFrame(values, index=pandas.Index(index, name='Country/Region'), columns=columns)
+    return df.sort_values(df.columns[-1], ascending=False)
+
+def write_synthetic_csv(path, countries=200, provinces=3, days=1000, seed=0):
+    '''Write a file in JHU time series format with <provinces> rows for each of <countries>.'''
+    rng = numpy.random.default_rng(seed)
+    names = [name for name in country_data if not name.startswith('[')]
+    names = [names[i] if i < len(names) else "Country %d" % i for i in range(countries)]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Province/State", "Country/Region", "Lat", "Long"] + synthetic_dates(days))
+        for name in names:
+            values = rng.poisson(rng.uniform(0, 500, (provinces, 1)), (provinces, days)).cumsum(axis=1)
+            for province in range(provinces):
+                writer.writerow(["Province %d" % province if provinces > 1 else "", name, "1.0", "2.0"] + values[province].tolist())
+
+# Former implementations, kept as reference.
+
+def pandas_parse(path):
+    '''Former parse path: read whole file with default dtypes, drop unused columns, condense to countries.'''
+    df = pandas.read_csv(path)
+    df = df.drop(["Province/State", "Lat", "Long"], axis=1)
+    return df.groupby("Country/Region").sum()
+
+def loop_insert_pop_column(df):
+    df.insert(0, 'Population', [get_country_population(country) for country in df.index.values])
+    return df
+
+def loop_insert_residents_per_case_column(df):
+    residents_per_case = []
+    for po, lc in zip(list(df['Population']), list(df[df.columns[-1]])):
+        try:
+            residents_per_case.append(round(po * 1000000 / lc))
+        except ZeroDivisionError:
+            residents_per_case.append(0)
+    df.insert(1, 'Residents per case', residents_per_case)
+    return df
+
+def loop_insert_trend_column(df, distance):
+    diff1 = df[df.columns[-1]] - df[df.columns[-(1 + distance)]]
+    diff2 = df[df.columns[-(1 + distance)]] - df[df.columns[-(1 + 2 * distance)]]
+    quot = -(1 - diff1 / diff2) * 100
+    df.insert(2, 'Trend', [round(x) if not (isinf(x) or isnan(x)) else "n/a at this time" for x in list(quot)])
+    return df
+
+def loop_append_double_rates(df_agr):
+    def f(x):
+        try:
+            return round(log10(2) / log10(1 + x / 100), 1)
+        except (ZeroDivisionError, ValueError):
+            return 0
+    df_agr['double_rates'] = [f(x) for x in df_agr["AGR (mean value)"]]
+    return df_agr
+
+def timeit(func, make_args, repeat=3):
+    '''Returns best wall time of <repeat> runs in secs; arguments are rebuilt for every run.'''
+    best = float('inf')
+    for _ in range(repeat):
+        args = make_args()
+        start = perf_counter()
+        func(*args)
+        best = min(best, perf_counter() - start)
+    return best
+
+def peak_memory(func, *args):
+    '''Returns peak memory in bytes allocated while running <func>.'''
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_parse(countries=200, provinces=3, days=1000, verbose=True):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'time_series.csv')
+        write_synthetic_csv(path, countries, provinces, days)
+        cases = [
+            ('pandas.read_csv + groupby', pandas_parse),
+            ('streaming ingest', lambda path: TimeSeriesIngest(get_country_continent).update(path)),
+            ('streaming ingest, last 14 days', lambda path: TimeSeriesIngest(get_country_continent, 14).update(path)),
+        ]
+        report = {'benchmark': 'parse', 'countries': countries, 'provinces': provinces, 'days': days,
+                  'file_mb': os.path.getsize(path) / 1e6, 'results': []}
+        for name, parse in cases:
+            report['results'].append({'parser': name, 'time_ms': timeit(parse, lambda: (path,)) * 1000,
+                                      'peak_mb': peak_memory(parse, path) / 1e6})
+    if verbose:
+        print("%d countries x %d provinces x %d days (%.1f MB)" % (countries, provinces, days, report['file_mb']))
+        print("%-36s %10s %10s" % ("parser", "time [ms]", "peak [MB]"))
+        for result in report['results']:
+            print("%-36s %10.1f %10.1f" % (result['parser'], result['time_ms'], result['peak_mb']))
+    return report
+
+def run_columns(regions=10000, days=1000, verbose=True):
+    data = CovidData('', '')
+    df = synthetic_frame(regions, days)
+    df_pop = loop_insert_pop_column(df.copy())
+    df_trend = loop_insert_residents_per_case_column(df_pop.copy())
+    df_agr = pandas.DataFrame({'AGR (mean value)': numpy.random.default_rng(1).uniform(-5, 50, regions).round(1)})
+    regions_list = list(df.index)
+    values = df.to_numpy(dtype='int32')
+    population = data._population_column(regions_list)
+    agr = df_agr['AGR (mean value)'].to_numpy()
+    cases = [
+        ('population', loop_insert_pop_column, lambda: (df.copy(),),
+            data._population_column, lambda: (regions_list,)),
+        ('residents per case', loop_insert_residents_per_case_column, lambda: (df_pop.copy(),),
+            data._residents_per_case_column, lambda: (population, values[:, -1])),
+        ('trend', loop_insert_trend_column, lambda: (df_trend.copy(), 6),
+            data._trend_column, lambda: (values, 6)),
+        ('double rates', loop_append_double_rates, lambda: (df_agr.copy(),),
+            data._compute_double_rates, lambda: (agr,)),
+    ]
+    report = {'benchmark': 'columns', 'regions': regions, 'days': days, 'results': []}
+    for name, loop, loop_args, vectorized, vectorized_args in cases:
+        report['results'].append({'stage': name, 'loop_ms': timeit(loop, loop_args) * 1000,
+                                  'vectorized_ms': timeit(vectorized, vectorized_args) * 1000})
+    if verbose:
+        print("%d regions x %d days" % (regions, days))
+        print("%-36s %10s %10s %8s" % ("stage", "loop [ms]", "vect [ms]", "speedup"))
+        for result in report['results']:
+            print("%-36s %10.2f %10.2f %7.1fx" % (result['stage'], result['loop_ms'], result['vectorized_ms'],
+                                                 result['loop_ms'] / result['vectorized_ms']))
+    return report
+
+def run_stages(countries=200, provinces=3, days=1000, verbose=True):
+    import lcd
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'time_series.csv')
+        write_synthetic_csv(path, countries, provinces, days)
+        data = CovidData(path, '')
+        ingest = TimeSeriesIngest(get_country_continent)
+        ingest.update(path)
+        tree, rows, dates = ingest.tree, ingest.region_rows, ingest.dates
+        abs_values, dif_values = ingest.abs_values, ingest.dif_values
+        abs_order = rows[argsort_descending(abs_values[rows, -1])]
+        abs_table = data._build_table(tree.names, dates, abs_values, abs_order)
+        dif_table = data._build_table(tree.names, dates[1:], dif_values, rows[argsort_descending(dif_values[rows, -1])])
+        snapshot = make_snapshot(abs_table, dif_table, 0.0, 1, tree)
+        country = abs_table.regions[len(abs_table) // 2]
+        view = data._abs_view(snapshot, 7, 0, country)
+        absval, relval, dat_start, dat_end = data._template_values(view)
+
+        def render():
+            with lcd.app.test_request_context('/confirmed/'):
+                return render_template('lcd.html', title='confirmed', rows=zip(absval, relval),
+                                       context=["confirmed", "", 7, 0, "cases", country, lcd.__version__, "", ""])
+        html = render()
+        archive_path = os.path.join(tmp_dir, 'archive')
+        archive = SnapshotArchive(archive_path)
+        for version in range(KEYFRAME_INTERVAL):             # a keyframe and a delta of one more day after each
+            last_day = len(dates) - KEYFRAME_INTERVAL + version + 1
+            archive.append(tree, dates[:last_day], abs_values[:, :last_day], float(version))
+        stages = [
+            ('parse + aggregate', lambda: TimeSeriesIngest(get_country_continent).update(path)),
+            ('diff', lambda: numpy.diff(abs_values, axis=1)),
+            ('sort', lambda: argsort_descending(abs_values[rows, -1])),
+            ('metadata columns', lambda: data._build_table(tree.names, dates, abs_values, abs_order)),
+            ('region tables', lambda: data._build_region_snapshot(snapshot, tree.find(country))),
+            ('rank index', lambda: RankIndex(abs_table, dif_table)),
+            ('prune + shrink + select', lambda: data._abs_view(snapshot, 7, 0, country)),
+            ('dif alignment + select', lambda: data._dif_view(snapshot, 7, 0, country)),
+            ('agr view', lambda: data._agr_view(snapshot, 8, 0, "")),
+            ('tolist', lambda: data._template_values(view)),
+            ('render', render),
+            ('compress', lambda: CompressedPage(html, 'bench')),
+            ('archive rebuild (%d deltas)' % (KEYFRAME_INTERVAL - 1), lambda: SnapshotArchive(archive_path).load(KEYFRAME_INTERVAL - 1)),
+        ]
+        report = {'benchmark': 'stages', 'countries': countries, 'provinces': provinces, 'days': days,
+                  'regions': len(abs_table), 'page_kb': len(html) / 1e3, 'results': []}
+        for name, stage in stages:
+            report['results'].append({'stage': name, 'time_ms': timeit(stage, lambda: ()) * 1000})
+    if verbose:
+        print("%d countries x %d provinces x %d days (%d regions, page %.0f kB)" % (
+            countries, provinces, days, report['regions'], report['page_kb']))
+        print("%-36s %10s" % ("stage", "time [ms]"))
+        for result in report['results']:
+            print("%-36s %10.2f" % (result['stage'], result['time_ms']))
+    return report
+
+LOAD_ROUTES = ['/confirmed/', '/confirmed_dif/', '/deaths/', '/deaths_dif/', '/recovered/', '/recovered_dif/',
+               '/av_growth_rate/', '/confirmed/?days=14&cases=0', '/api/v1/confirmed/abs?cases=0']
+
+def _load_route(url, secs, threads):
+    '''Request <url> from <threads> threads for <secs>, returns (number of requests, latencies in secs).'''
+    latencies = []
+    deadline = perf_counter() + secs
+
+    def client():
+        own = []
+        while perf_counter() < deadline:
+            start = perf_counter()
+            with urllib.request.urlopen(url) as response:
+                response.read()
+            own.append(perf_counter() - start)
+        latencies.extend(own)
+    clients = [threading.Thread(target=client) for _ in range(threads)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return latencies
+
+def run_load(secs=2, threads=8, countries=200, provinces=3, days=1000, verbose=True):
+    import lcd
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        for seed, data in enumerate(lcd.scheduler.datasets):
+            source = os.path.join(tmp_dir, 'source_' + data.filepath)
+            write_synthetic_csv(source, countries, provinces, days, seed)
+            data.source.url = 'file://' + source
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', 0, lcd.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = 'http://127.0.0.1:%d' % server.server_port
+        report = {'benchmark': 'load', 'secs': secs, 'threads': threads, 'countries': countries,
+                  'provinces': provinces, 'days': days, 'results': []}
+        try:
+            for route in LOAD_ROUTES:
+                urllib.request.urlopen(base + route).read()         # load data and warm the caches
+                latencies = numpy.array(_load_route(base + route, secs, threads))
+                report['results'].append({'route': route, 'requests': len(latencies), 'rps': len(latencies) / secs,
+                                          'p50_ms': numpy.percentile(latencies, 50) * 1000,
+                                          'p99_ms': numpy.percentile(latencies, 99) * 1000})
+        finally:
+            server.shutdown()
+            os.chdir(cwd)
+    if verbose:
+        print("%d countries x %d provinces x %d days, %d threads, %d secs per route" % (countries, provinces, days, threads, secs))
+        print("%-36s %10s %10s %10s" % ("route", "req/s", "p50 [ms]", "p99 [ms]"))
+        for result in report['results']:
+            print("%-36s %10.0f %10.2f %10.2f" % (result['route'], result['rps'], result['p50_ms'], result['p99_ms']))
+    return report
+
+if __name__ == '__main__':
+    benchmarks = {'columns': run_columns, 'parse': run_parse, 'stages': run_stages, 'load': run_load}
+    args = [arg for arg in sys.argv[1:] if arg != '--json']
+    as_json = len(args) < len(sys.argv) - 1
+    if not args or args[0] not in benchmarks:
+        sys.exit("usage: python lcd_bench.py columns|parse|stages|load [sizes...] [--json]")
+    with contextlib.redirect_stdout(sys.stderr if as_json else sys.stdout):    # keep progress messages out of the json
+        report = benchmarks[args[0]](*[int(arg) for arg in args[1:]], verbose=not as_json)
+    if as_json:
+        print(json.dumps(report, indent=2))
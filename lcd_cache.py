@@ -0,0 +1,139 @@
+#
+# Small thread safe caches used on the request path.
+#
+
+import gzip
+import zlib
+import threading
+
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STREAM_BUFFER = 1 << 14     # bytes collected before a chunk of a streamed page is sent
+
+class LRUCache:
+    '''
+    Bounded mapping which discards the least recently used entry when full.
+    Counts hits, misses and evictions.
+    With <maxbytes> entries are also discarded while the total of their sizes (as returned by
+    <sizeof>(value)) exceeds it; a single entry larger than <maxbytes> is not kept at all.
+    '''
+    def __init__(self, maxsize, maxbytes=0, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.maxbytes else 0
+        with self._lock:
+            if self.maxbytes and size > self.maxbytes:       # would only displace all other entries
+                if key in self._data:
+                    del self._data[key]
+                    self.bytes -= self._sizes.pop(key)
+                return
+            self.bytes += size - self._sizes.get(key, 0)
+            self._data[key] = value
+            self._sizes[key] = size
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize or (self.maxbytes and self.bytes > self.maxbytes):
+                old_key, _ = self._data.popitem(last=False)
+                self.bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        '''
+        Return cached value for <key> or call <compute>() and cache its result.
+        <compute> runs outside the lock, so concurrent misses may compute the same value twice.
+        '''
+        value = self.get(key, self)
+        if value is self:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def stats(self):
+        '''Returns the counters and the current size as dict.'''
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class CompressedPage:
+    '''
+    Rendered page kept as gzip and (if the brotli module is available) brotli encoded body.
+    The plain body is decompressed for the few clients accepting neither, so it does not take memory.
+    <tag> identifies the content; every encoding gets its own strong ETag derived from it.
+    '''
+    def __init__(self, body, tag):
+        raw = body.encode('utf-8')
+        self.tag = tag
+        self.bodies = {'gzip': gzip.compress(raw, compresslevel=6, mtime=0)}
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(raw, quality=5)
+
+    @property
+    def nbytes(self):
+        '''Size of the kept bodies in bytes.'''
+        return sum(len(body) for body in self.bodies.values())
+
+    def body(self, encoding):
+        '''Returns the body in <encoding> (see select_encoding()).'''
+        if encoding == 'identity':
+            return gzip.decompress(self.bodies['gzip'])
+        return self.bodies[encoding]
+
+    def select_encoding(self, accept_encodings):
+        '''Returns the best encoding accepted by the client (werkzeug Accept object).'''
+        for encoding in ('br', 'gzip'):
+            if encoding in self.bodies and accept_encodings[encoding] > 0:
+                return encoding
+        return 'identity'
+
+    def etag(self, encoding):
+        return self.tag if encoding == 'identity' else self.tag + '-' + encoding
+
+def stream_encoded(chunks, encoding):
+    '''
+    Yields the str <chunks> of a streamed page utf-8 encoded and, if <encoding> is 'gzip', compressed,
+    in pieces of about STREAM_BUFFER bytes. Each piece is flushed, so it reaches the client right away.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if encoding == 'gzip' else None
+    buffer, size = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_BUFFER:
+            data = ''.join(buffer).encode('utf-8')
+            buffer, size = [], 0
+            yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+    data = ''.join(buffer).encode('utf-8')
+    yield compressor.compress(data) + compressor.flush() if compressor else data
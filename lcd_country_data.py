@@ -5,6 +5,11 @@
 # License : CC BY-4.0
 #
 
+import numpy
+import threading
+
+UNMATCHED_SHOWN = 10        # max. number of region names without metadata listed in the log
+
 def get_country_population(country):
     '''
     Returns country population in mn
@@ -29,7 +34,7 @@ country_data = {
 "[Asia]": ["", 4526007227, ""],
 "[South America]": ["", 423558844, ""],
 "[Africa]": ["", 1262842470, ""],
-"[Ocenia]": ["", 41781406, ""],
+"[Oceania]": ["", 41781406, ""],
 "Afghanistan": ["AFG", 37172386, "AS"],
 "Albania": ["ALB", 2866376, "EU"],
 "Algeria": ["DZA", 42228429, "AF"],
@@ -262,4 +267,47 @@ continent = {
 "AS": "[Asia]",
 "OC": "[Oceania]",
 "AF": "[Africa]"
-}
\ No newline at end of file
+}
+
+class CountryTable:
+    '''
+    Country metadata as arrays, so the population and continent of all regions of a table
+    are looked up in one call each. Region names without metadata are collected in
+    <unmatched> and reported once, the first time they are looked up (the first UNMATCHED_SHOWN
+    of them and how many more, e.g. the counties of the US files).
+    '''
+    def __init__(self, country_data, continent):
+        self.position = {country: row for row, country in enumerate(country_data)}
+        self.population_mn = numpy.array([round(pop / 1000000, 1) for code, pop, con in country_data.values()], dtype='float64')
+        self.continents = sorted(set(continent.values()))
+        codes = {name: code for code, name in enumerate(self.continents)}
+        self.continent_code = numpy.array([codes.get(continent.get(con), -1) for code, pop, con in country_data.values()], dtype='int8')
+        self.unmatched = set()
+        self._lock = threading.Lock()
+
+    def rows(self, regions):
+        '''Returns the row of each of <regions>, -1 for names without metadata.'''
+        position = self.position
+        rows = numpy.fromiter((position.get(region, -1) for region in regions), dtype='intp', count=len(regions))
+        if (rows < 0).any():
+            missing = {region for region, row in zip(regions, rows.tolist()) if row < 0}
+            with self._lock:
+                missing -= self.unmatched
+                self.unmatched |= missing
+            if missing:
+                missing = sorted(missing)
+                more = len(missing) - UNMATCHED_SHOWN
+                print("no country data for:", ', '.join(missing[:UNMATCHED_SHOWN]) + (" and %d more" % more if more > 0 else ""))
+        return rows
+
+    def population(self, regions):
+        '''Returns population in mn of each of <regions> (0 if unknown).'''
+        rows = self.rows(regions)
+        return numpy.where(rows >= 0, self.population_mn[rows], 0.0)
+
+    def continent(self, regions):
+        '''Returns continent of each of <regions> as int8 code into <continents> (-1 if n/a).'''
+        rows = self.rows(regions)
+        return numpy.where(rows >= 0, self.continent_code[rows], -1).astype('int8')
+
+country_table = CountryTable(country_data, continent)
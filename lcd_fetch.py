@@ -0,0 +1,124 @@
+#
+# Conditional download of the JHU time series files.
+#
+# The ETag, Last-Modified header and a SHA-256 hash of the content are kept in
+# a small json file next to the downloaded file (<filepath>.meta), so unchanged
+# files are neither transferred nor parsed again and a restarted process can
+# serve its local copy without any network call.
+#
+# fetch() uses urllib and blocks; fetch_async() does the same with an aiohttp
+# session so several files can be downloaded concurrently on one event loop.
+#
+
+import os
+import json
+import hashlib
+import urllib.error
+import urllib.request
+
+from time import time
+
+FETCH_TIMEOUT = 60      # secs
+
+def _meta_path(filepath):
+    return filepath + '.meta'
+
+def load_meta(filepath):
+    '''Returns the metadata stored for <filepath> or an empty dict.'''
+    try:
+        with open(_meta_path(filepath)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_meta(filepath, meta):
+    tmp_path = _meta_path(filepath) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, _meta_path(filepath))
+
+def _file_hash(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _intact_meta(filepath):
+    '''Returns the metadata stored for <filepath> if the local copy matches it, otherwise an empty dict.'''
+    meta = load_meta(filepath)
+    if not meta or not os.path.exists(filepath) or _file_hash(filepath) != meta.get('sha256'):
+        return {}
+    return meta
+
+def local_copy_time(filepath):
+    '''
+    Returns the time <filepath> was fetched if the local copy is intact, otherwise None.
+    An intact local copy can be parsed without asking the server first.
+    '''
+    return _intact_meta(filepath).get('fetch_time')
+
+def _conditional_headers(filepath, meta):
+    '''Returns the headers asking the server to send <filepath> only if it was modified; <meta> must be intact.'''
+    headers = {}
+    if meta and os.path.exists(filepath):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+def _not_modified(filepath, meta):
+    meta['fetch_time'] = time()
+    _save_meta(filepath, meta)
+    return False
+
+def _store(url, filepath, meta, content, headers):
+    '''Write downloaded <content> to <filepath> if it differs from the local copy, returns True if so.'''
+    sha256 = hashlib.sha256(content).hexdigest()
+    changed = sha256 != meta.get('sha256') or not os.path.exists(filepath)
+    if changed:
+        tmp_path = filepath + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, filepath)
+    _save_meta(filepath, {
+        'url': url,
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'sha256': sha256,
+        'fetch_time': time(),
+    })
+    return changed
+
+def fetch(url, filepath, timeout=FETCH_TIMEOUT):
+    '''
+    Download <url> to <filepath> unless the server reports it as not modified.
+    Returns True if the content of <filepath> has changed.
+    A local copy that does not match its metadata (e.g. edited or truncated) is downloaded unconditionally.
+    '''
+    meta = _intact_meta(filepath)
+    request = urllib.request.Request(url, headers=_conditional_headers(filepath, meta))
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            content = response.read()
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        return _not_modified(filepath, meta)
+    return _store(url, filepath, meta, content, headers)
+
+async def fetch_async(session, url, filepath):
+    '''
+    Same as fetch(), but downloads with aiohttp ClientSession <session> (which sets the timeout).
+    Only the download is asynchronous, the small local file operations are not.
+    '''
+    meta = _intact_meta(filepath)
+    async with session.get(url, headers=_conditional_headers(filepath, meta)) as response:
+        if response.status == 304:
+            return _not_modified(filepath, meta)
+        response.raise_for_status()
+        content = await response.read()
+        headers = response.headers
+    return _store(url, filepath, meta, content, headers)
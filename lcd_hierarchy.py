@@ -0,0 +1,95 @@
+#
+# Region hierarchy of a time series file: county -> state -> country -> continent -> World.
+#
+# The nodes of all levels are numbered top down, level by level, and within a
+# level by parent, so the children of every node are a contiguous range. The
+# values of all nodes are then aggregated bottom up in one pass over the levels:
+# one reduceat sums the rows of a level into their parents, no groupby and no
+# loop over regions. The resulting matrix holds every node, so any of them can
+# be served without aggregating again.
+#
+
+import numpy
+
+LEVELS = ('world', 'continent', 'country', 'state', 'county')
+COUNTRY = LEVELS.index('country')
+WORLD = '[World]'
+
+class RegionTree:
+    '''
+    Nodes of the region hierarchy: <names>, <parent> (-1 for World, node 0) and <level> (index into LEVELS).
+    <leaf_nodes> maps the rows of the file to their nodes and is only needed for aggregate().
+    '''
+    def __init__(self, names, parent, level, leaf_nodes=None):
+        self.names = list(names)
+        self.parent = numpy.asarray(parent, dtype='intp')
+        self.level = numpy.asarray(level, dtype='int8')
+        self.leaf_nodes = leaf_nodes
+        bounds = numpy.searchsorted(self.level, numpy.arange(self.level.max() + 2))
+        self.child_start = numpy.searchsorted(self.parent[1:], numpy.arange(len(self.names)), side='left') + 1
+        self.child_stop = numpy.searchsorted(self.parent[1:], numpy.arange(len(self.names)), side='right') + 1
+        # per level bottom up: (first node, end of nodes, their distinct parents, start of each parent's children)
+        self._plan = []
+        for lo, hi in reversed(list(zip(bounds[1:-1].tolist(), bounds[2:].tolist()))):
+            parents, starts = numpy.unique(self.parent[lo:hi], return_index=True)
+            self._plan.append((lo, hi, parents, starts))
+        if leaf_nodes is not None:
+            self._leaf_order = numpy.argsort(leaf_nodes, kind='stable')
+            self._leaf_targets, self._leaf_starts = numpy.unique(leaf_nodes[self._leaf_order], return_index=True)
+            self._unique_leaves = len(self._leaf_targets) == len(leaf_nodes)
+        self.keys = []
+        for node, name in enumerate(self.names):
+            below_country = self.level[node] > COUNTRY
+            self.keys.append(self.keys[self.parent[node]] + '/' + name if below_country else name)
+        self.position = {key: node for node, key in enumerate(self.keys)}
+
+    @classmethod
+    def from_paths(cls, paths):
+        '''
+        Returns RegionTree of the rows of a file, <paths> holds (continent, country, state, ...) of each row
+        without trailing empty names. A row may be a node that has children, e.g. the mainland of a country.
+        '''
+        node_of = {(): 0}
+        names, parent, level = [WORLD], [-1], [0]
+        for depth in range(1, max(map(len, paths), default=0) + 1):
+            prefixes = {path[:depth] for path in paths if len(path) >= depth}
+            for prefix in sorted(prefixes, key=lambda prefix: (node_of[prefix[:-1]], prefix[-1])):
+                node_of[prefix] = len(names)
+                names.append(prefix[-1])
+                parent.append(node_of[prefix[:-1]])
+                level.append(depth)
+        leaf_nodes = numpy.array([node_of[path] for path in paths], dtype='intp')
+        return cls(names, parent, level, leaf_nodes)
+
+    def __len__(self):
+        return len(self.names)
+
+    def country_nodes(self):
+        '''Returns the nodes at country level and above (countries, continents and the world), ordered by name.'''
+        return numpy.array(sorted(numpy.flatnonzero(self.level <= COUNTRY), key=lambda node: self.names[node]), dtype='intp')
+
+    def find(self, key):
+        '''Returns the node of <key> ('[Europe]', 'US' or 'US/New York'), None if there is none.'''
+        return self.position.get(key)
+
+    def subregions(self, node):
+        '''Returns <node> followed by its children.'''
+        return numpy.concatenate([[node], numpy.arange(self.child_start[node], self.child_stop[node])]).astype('intp')
+
+    def aggregate(self, rows, out=None):
+        '''
+        Returns int64 values (nodes x columns) of every node for the values <rows> (file rows x columns).
+        With <out> (nodes x columns, e.g. int32) the values are written there instead; the sums must fit its type.
+        '''
+        if out is None:
+            values = numpy.zeros((len(self.names), rows.shape[1]), dtype='int64')
+        else:
+            values = out
+            values[...] = 0
+        if self._unique_leaves:
+            values[self.leaf_nodes] = rows         # the usual case: every row of the file is a node of its own
+        elif len(rows):
+            values[self._leaf_targets] = numpy.add.reduceat(rows[self._leaf_order], self._leaf_starts, axis=0)
+        for lo, hi, parents, starts in self._plan:
+            values[parents] += numpy.add.reduceat(values[lo:hi], starts, axis=0)
+        return values
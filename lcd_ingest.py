@@ -0,0 +1,331 @@
+#
+# Ingest of the JHU time series files.
+#
+# The files only grow by one date column per day. TimeSeriesIngest keeps the
+# aggregated values of the previous version together with the length and CRC
+# of every line of it. If a new version only appends date columns to every
+# line, just these columns are parsed, aggregated and diffed. Anything else,
+# e.g. revised past values or new rows, leads to a full rebuild.
+#
+# Both the global files (one row per province) and the US files (one row per
+# county) are read; the rows are aggregated up the region hierarchy, see
+# lcd_hierarchy.
+#
+# LongFormatIngest reads files with one row per location and date instead (e.g.
+# the OWID covid data, as CSV or Parquet) into the same representation.
+#
+
+import csv
+import zlib
+import numpy
+
+from operator import itemgetter
+from lcd_hierarchy import RegionTree
+
+INT32_MAX = numpy.iinfo('int32').max
+
+# names of the region columns from the country down, global files first
+PATH_COLUMNS = (('Country/Region', 'Country_Region'), ('Province/State', 'Province_State'), ('Admin2',))
+
+class ColumnBuffer:
+    '''
+    int32 matrix (rows x columns) with spare capacity (an eighth, at least 16 columns), so appending
+    N columns costs O(rows x N) amortized.
+    Views returned by <values> stay valid (and unchanged) when columns are appended.
+    The initial <rows> x <columns> values are uninitialized, to be filled through <values>.
+    '''
+    def __init__(self, rows, columns):
+        self.rows, self.columns = rows, columns
+        self._data = numpy.empty((self.rows, self._capacity(columns)), dtype='int32')
+
+    @staticmethod
+    def _capacity(columns):
+        return columns + max(columns // 8, 16)
+
+    @property
+    def values(self):
+        return self._data[:, :self.columns]
+
+    def append(self, values):
+        '''Append columns <values> (rows x N).'''
+        columns = self.columns + values.shape[1]
+        if columns > self._data.shape[1]:
+            data = numpy.empty((self.rows, self._capacity(columns)), dtype='int32')
+            data[:, :self.columns] = self.values
+            self._data = data
+        self._data[:, self.columns:columns] = values
+        self.columns = columns
+
+def _parse_numbers(text, count):
+    '''
+    Returns int32 array of <count> comma separated numbers in <text>; empty fields count as 0.
+    Raises OverflowError if a number does not fit into int32.
+    '''
+    fields = ',' + text + ','
+    if ',,' in fields or '.' in text:      # fromstring would stop at empty fields or decimals
+        values = numpy.array([int(float(field)) if field.strip() else 0 for field in text.split(',')], dtype='int64')
+    else:
+        values = numpy.fromstring(text, dtype='int64', sep=',')
+    if values.size and (values.max() > INT32_MAX or values.min() < -INT32_MAX):
+        raise OverflowError("number out of int32 range in line ending with: " + text[-80:])
+    return values.astype('int32')
+
+def _check_totals(raw):
+    '''Raises OverflowError if the column totals of <raw> (file rows x columns), and so the sums of any node, do not fit into int32.'''
+    totals = raw.sum(axis=0, dtype='int64')
+    if totals.size and (totals.max() > INT32_MAX or totals.min() < -INT32_MAX):
+        raise OverflowError("the totals of the file do not fit into int32")
+
+def _count_lines(f):
+    '''Returns an upper bound of the number of lines of binary file <f> from its current position, which is kept.'''
+    start = f.tell()
+    count = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 16), b'')) + 1
+    f.seek(start)
+    return count
+
+def _lines(f):
+    '''Yields the non empty lines of binary file <f> without line breaks.'''
+    for line in f:
+        line = line.rstrip(b'\r\n')
+        if line.strip():
+            yield line
+
+def _jhu_date(iso_date):
+    '''Returns ISO date (e.g. 2020-03-21, possibly with time) in the format of the JHU files: 3/21/20.'''
+    year, month, day = iso_date[:10].split('-')
+    return '%d/%d/%s' % (int(month), int(day), year[-2:])
+
+def _is_date(field):
+    parts = field.split('/')
+    return len(parts) == 3 and all(part.isdigit() for part in parts)
+
+class TimeSeriesIngest:
+    '''
+    Aggregates a JHU time series file (one row per province or county) to every node of the
+    region hierarchy: counties, states, countries, continents (via <continent_of>) and the world.
+
+    The file is streamed line by line and only the date and region columns are parsed.
+    With <last_days> only the last N date columns are parsed; this always rebuilds
+    fully (which is cheap then) and N must be at least 13 to compute the trend.
+
+    After update() <tree> (the RegionTree), <dates>, <abs_values> and <dif_values> (rows like
+    the nodes of the tree) hold the result, the dif values have one column less than the abs
+    values (no predecessor for the first date). <regions> are the countries, continents and
+    the world in alphabetical order and <region_rows> their rows.
+    '''
+    def __init__(self, continent_of, last_days=None):
+        self.continent_of = continent_of
+        self.last_days = last_days
+        self.tree = None
+        self.regions = None
+        self.region_rows = None
+        self.dates = None
+        self._abs = None
+        self._dif = None
+        self._line_lengths = None
+        self._line_crcs = None
+
+    @property
+    def abs_values(self):
+        return self._abs.values
+
+    @property
+    def dif_values(self):
+        return self._dif.values
+
+    def _aggregate(self, raw):
+        '''Returns node values (nodes x days) for row values <raw> (rows x days).'''
+        return self.tree.aggregate(raw)
+
+    def _full_update(self, f):
+        '''
+        Parse the whole file. The rows are parsed into one preallocated int32 matrix and
+        aggregated straight into the column buffers, so no int64 copy of the data is made.
+        '''
+        max_rows = max(_count_lines(f) - 1, 0)
+        lines = _lines(f)
+        header = next(lines)
+        fields = next(csv.reader([header.decode('utf-8')]))
+        first_date = next((col for col, field in enumerate(fields) if _is_date(field)), len(fields))
+        path_columns = [col for names in PATH_COLUMNS for col, field in enumerate(fields) if field in names]
+        self.dates = fields[first_date:]
+        if self.last_days:
+            self.dates = self.dates[-self.last_days:]
+        count = len(self.dates)
+        lengths, crcs = [len(header)], [zlib.crc32(header)]
+        paths, continents = [], {}
+        raw = numpy.empty((max_rows, count), dtype='int32')
+        for line in lines:
+            text = line.decode('utf-8')
+            prefix = text.rsplit(',', count)[0]
+            row = next(csv.reader([prefix]))
+            path = [row[col].strip() for col in path_columns]
+            while path and not path[-1]:
+                path.pop()
+            country = path[0] if path else ''
+            if country not in continents:
+                continents[country] = self.continent_of(country)
+            raw[len(paths)] = _parse_numbers(text[len(prefix) + 1:], count)
+            paths.append((continents[country],) + tuple(path))
+            lengths.append(len(line))
+            crcs.append(zlib.crc32(line))
+
+        self.tree = RegionTree.from_paths(paths)
+        self.region_rows = self.tree.country_nodes()
+        self.regions = [self.tree.names[node] for node in self.region_rows]
+        raw = raw[:len(paths)]
+        _check_totals(raw)
+        self._abs = ColumnBuffer(len(self.tree), count)
+        self.tree.aggregate(raw, out=self._abs.values)
+        self._dif = ColumnBuffer(len(self.tree), max(count - 1, 0))
+        numpy.subtract(self.abs_values[:, 1:], self.abs_values[:, :-1], out=self._dif.values)
+        self._line_lengths, self._line_crcs = lengths, crcs
+
+    def _append_update(self, f):
+        '''
+        Ingest the date columns appended to every line since the last update.
+        Returns the number of new dates or None if the file was changed otherwise.
+        '''
+        lengths, crcs, new_dates, raw = [], [], None, []
+        for row, line in enumerate(_lines(f)):
+            if row >= len(self._line_lengths):
+                return None
+            length = self._line_lengths[row]
+            if len(line) <= length or line[length:length + 1] != b',':
+                return None
+            crc = zlib.crc32(line[:length])
+            if crc != self._line_crcs[row]:
+                return None
+            tail = line[length + 1:].decode('utf-8')
+            if new_dates is None:
+                new_dates = tail.split(',')
+            else:
+                raw.append(_parse_numbers(tail, len(new_dates)))
+                if len(raw[-1]) != len(new_dates):
+                    return None
+            lengths.append(len(line))
+            crcs.append(zlib.crc32(line[length:], crc))
+        if len(lengths) != len(self._line_lengths) or not raw:
+            return None
+        raw = numpy.vstack(raw)
+        _check_totals(raw)
+        values = self._aggregate(raw)
+        last_values = self.abs_values[:, -1:].astype('int64')
+        self._dif.append(numpy.diff(numpy.hstack([last_values, values]), axis=1))
+        self._abs.append(values)
+        self.dates = self.dates + new_dates
+        self._line_lengths, self._line_crcs = lengths, crcs
+        return len(new_dates)
+
+    def update(self, filepath):
+        '''
+        Ingest the current version of <filepath>.
+        Returns the number of date columns parsed, which equals the number of all dates after a full rebuild.
+        '''
+        with open(filepath, 'rb') as f:
+            if self._line_lengths is not None and not self.last_days:
+                days_added = self._append_update(f)
+                if days_added is not None:
+                    return days_added
+                f.seek(0)
+            self._full_update(f)
+        return len(self.dates)
+
+class LongFormatIngest:
+    '''
+    Aggregates a long format file (one row per location and date) to every node of the region
+    hierarchy: countries, continents (via <continent_of>) and the world. After update() it has
+    the same attributes as TimeSeriesIngest.
+
+    <columns> names the location, date (ISO, e.g. 2020-03-21, stored like 3/21/20) and value column. The values must
+    be cumulative (e.g. total_cases of the OWID data); a missing value repeats the previous one of
+    the location. Rows with an iso_code starting with OWID_ are aggregates (World, continents,
+    income groups) and skipped, the region tree sums up the countries itself.
+
+    Only the needed columns are read, CSV with the csv module and Parquet (<parquet>, requires
+    pyarrow) with pyarrow; the rows are then put into the matrix in one vectorized step. The rows
+    of these files are ordered by location, so new dates are not appended at the end and every
+    update parses the whole file.
+    '''
+    def __init__(self, continent_of, columns=('location', 'date', 'total_cases'), last_days=None, parquet=False):
+        self.continent_of = continent_of
+        self.columns = tuple(columns)
+        self.last_days = last_days
+        self.parquet = parquet
+        self.tree = None
+        self.regions = None
+        self.region_rows = None
+        self.dates = None
+        self.abs_values = None
+        self.dif_values = None
+
+    def _read_csv(self, filepath):
+        '''Returns the locations, dates, values (str, empty if missing) and iso codes (None if n/a) of a CSV file.'''
+        with open(filepath, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            missing = [name for name in self.columns if name not in header]
+            if missing:
+                raise ValueError("%s has no column %s" % (filepath, ', '.join(missing)))
+            wanted = [header.index(name) for name in self.columns]
+            has_iso = 'iso_code' in header
+            if has_iso:
+                wanted.append(header.index('iso_code'))
+            columns = list(zip(*map(itemgetter(*wanted), filter(None, reader))))
+        if not columns:
+            columns = [()] * len(wanted)
+        return columns[0], columns[1], numpy.array(columns[2], dtype=object), columns[3] if has_iso else None
+
+    def _read_parquet(self, filepath):
+        '''Returns the locations, dates, values (float, NaN if missing) and iso codes (None if n/a) of a Parquet file.'''
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet files require pyarrow")
+        names = pyarrow.parquet.read_schema(filepath).names
+        table = pyarrow.parquet.read_table(filepath, columns=list(self.columns) + (['iso_code'] if 'iso_code' in names else []))
+        location, date, value = self.columns
+        dates = table.column(date).cast(pyarrow.string()).to_pylist()
+        values = table.column(value).cast(pyarrow.float64()).to_numpy()
+        iso_codes = table.column('iso_code').to_pylist() if 'iso_code' in names else None
+        return table.column(location).to_pylist(), dates, values, iso_codes
+
+    def _matrix(self, locations, dates, values):
+        '''
+        Returns locations, dates (both sorted) and int32 matrix of <values> with the gaps filled forward.
+        Raises OverflowError if a value does not fit into int32.
+        '''
+        names, rows = numpy.unique(numpy.array(locations, dtype=str), return_inverse=True)
+        days, cols = numpy.unique(numpy.array(dates, dtype=str), return_inverse=True)
+        matrix = numpy.full((len(names), len(days)), numpy.nan)
+        matrix[rows, cols] = values
+        known = numpy.where(numpy.isnan(matrix), -1, numpy.arange(len(days)))
+        last_known = numpy.maximum.accumulate(known, axis=1)
+        filled = matrix[numpy.arange(len(names))[:, None], numpy.maximum(last_known, 0)]
+        filled = numpy.rint(numpy.where(last_known >= 0, filled, 0))
+        if filled.size and (filled.max() > INT32_MAX or filled.min() < -INT32_MAX):
+            raise OverflowError("value out of int32 range")
+        return names.tolist(), [_jhu_date(day) for day in days.tolist()], filled.astype('int32')
+
+    def update(self, filepath):
+        '''Ingest the current version of <filepath>. Returns the number of date columns parsed (all of them).'''
+        locations, dates, values, iso_codes = (self._read_parquet if self.parquet else self._read_csv)(filepath)
+        if values.dtype == object:
+            numbers = numpy.full(len(values), numpy.nan)
+            given = values != ''
+            numbers[given] = values[given].astype('float64')
+            values = numbers
+        if iso_codes is not None:
+            countries = ~numpy.char.startswith(numpy.array([code or '' for code in iso_codes], dtype=str), 'OWID_')
+            locations, dates, values = numpy.array(locations, dtype=str)[countries], numpy.array(dates, dtype=str)[countries], values[countries]
+        names, self.dates, raw = self._matrix(locations, dates, values)
+        if self.last_days:
+            self.dates, raw = self.dates[-self.last_days:], raw[:, -self.last_days:]
+        self.tree = RegionTree.from_paths([(self.continent_of(name), name) for name in names])
+        self.region_rows = self.tree.country_nodes()
+        self.regions = [self.tree.names[node] for node in self.region_rows]
+        _check_totals(raw)
+        self.abs_values = self.tree.aggregate(raw, out=numpy.empty((len(self.tree), len(self.dates)), dtype='int32'))
+        self.dif_values = numpy.diff(self.abs_values, axis=1)
+        return len(self.dates)
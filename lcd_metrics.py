@@ -0,0 +1,123 @@
+#
+# Timing instrumentation of the hot paths and the /metrics route.
+#
+# Stage timers (download, parse, column builders, views, rendering) are only
+# active with LCD_METRICS=1; otherwise timed() hands out one shared no-op
+# context manager and stage() leaves the decorated function untouched.
+# Timed requests also get a Server-Timing header with their own stages.
+#
+# The gauges (cache counters, snapshot age and size, refresh in flight) are
+# read when /metrics is scraped and cost nothing in between.
+#
+
+import os
+import threading
+
+from contextlib import nullcontext
+from functools import wraps
+from time import perf_counter, time
+from flask import Response, g, has_request_context
+
+ENABLED = os.environ.get('LCD_METRICS', '') == '1'
+
+_NOT_TIMED = nullcontext()
+_lock = threading.Lock()
+_stages = {}            # stage -> [count, total secs, max secs]
+
+def _record(name, secs):
+    with _lock:
+        entry = _stages.get(name)
+        if entry is None:
+            _stages[name] = [1, secs, secs]
+        else:
+            entry[0] += 1
+            entry[1] += secs
+            entry[2] = max(entry[2], secs)
+    if has_request_context():
+        g.setdefault('server_timing', []).append((name, secs))
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        _record(self.name, perf_counter() - self.start)
+
+def timed(name):
+    '''Context manager timing the stage <name> (a no-op unless metrics are enabled).'''
+    return _Timer(name) if ENABLED else _NOT_TIMED
+
+def stage(name):
+    '''Decorator timing each call as stage <name>; returns the function unchanged unless metrics are enabled.'''
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def add_server_timing(response):
+    '''after_request hook adding the stages timed during the request as Server-Timing header.'''
+    timings = g.pop('server_timing', None)
+    if timings:
+        response.headers['Server-Timing'] = ', '.join('%s;dur=%.2f' % (name, secs * 1000) for name, secs in timings)
+    return response
+
+def _metric(lines, name, kind, help_text, samples):
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s %s' % (name, kind))
+    for labels, value in samples:
+        label_text = ','.join('%s="%s"' % item for item in labels.items())
+        lines.append('%s{%s} %s' % (name, label_text, repr(float(value))) if labels else '%s %s' % (name, repr(float(value))))
+
+def render_metrics(datasets, caches):
+    '''
+    Returns the metrics in Prometheus text format.
+    <datasets>: dict name -> CovidData, <caches>: dict name -> LRUCache.
+    '''
+    lines = []
+    with _lock:
+        stages = {name: list(entry) for name, entry in _stages.items()}
+    _metric(lines, 'lcd_stage_seconds_count', 'counter', 'Number of timed calls of a stage.',
+            [({'stage': name}, entry[0]) for name, entry in sorted(stages.items())])
+    _metric(lines, 'lcd_stage_seconds_sum', 'counter', 'Total secs spent in a stage.',
+            [({'stage': name}, entry[1]) for name, entry in sorted(stages.items())])
+    _metric(lines, 'lcd_stage_seconds_max', 'gauge', 'Longest call of a stage in secs.',
+            [({'stage': name}, entry[2]) for name, entry in sorted(stages.items())])
+
+    cache_stats = {name: cache.stats() for name, cache in caches.items()}
+    for counter in ('hits', 'misses', 'evictions'):
+        _metric(lines, 'lcd_cache_%s_total' % counter, 'counter', 'Cache %s.' % counter,
+                [({'cache': name}, stats[counter]) for name, stats in sorted(cache_stats.items())])
+    _metric(lines, 'lcd_cache_hit_ratio', 'gauge', 'Cache hits per lookup.',
+            [({'cache': name}, stats['hits'] / max(stats['hits'] + stats['misses'], 1)) for name, stats in sorted(cache_stats.items())])
+    _metric(lines, 'lcd_cache_entries', 'gauge', 'Number of cached entries.',
+            [({'cache': name}, stats['size']) for name, stats in sorted(cache_stats.items())])
+    _metric(lines, 'lcd_cache_bytes', 'gauge', 'Size of the cached entries in bytes (0 if the cache is not bounded by size).',
+            [({'cache': name}, stats['bytes']) for name, stats in sorted(cache_stats.items())])
+
+    snapshots = [(name, data, data.snapshot) for name, data in sorted(datasets.items())]
+    _metric(lines, 'lcd_snapshot_age_seconds', 'gauge', 'Secs since the data was last updated.',
+            [({'dataset': name}, time() - snapshot.last_update_time) for name, data, snapshot in snapshots if snapshot])
+    _metric(lines, 'lcd_snapshot_version', 'gauge', 'Version of the served data.',
+            [({'dataset': name}, snapshot.version) for name, data, snapshot in snapshots if snapshot])
+    _metric(lines, 'lcd_snapshot_bytes', 'gauge', 'Size of the arrays of the served data.',
+            [({'dataset': name}, snapshot.abs_table.nbytes + snapshot.dif_table.nbytes) for name, data, snapshot in snapshots if snapshot])
+    _metric(lines, 'lcd_refresh_in_progress', 'gauge', '1 while the data is being reloaded.',
+            [({'dataset': name}, data._refresh_lock.locked()) for name, data, snapshot in snapshots])
+    return '\n'.join(lines) + '\n'
+
+def metrics_view(datasets, caches):
+    '''Returns view function serving render_metrics(<datasets>, <caches>).'''
+    def metrics():
+        return Response(render_metrics(datasets, caches), mimetype='text/plain; version=0.0.4')
+    return metrics
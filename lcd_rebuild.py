@@ -0,0 +1,94 @@
+#
+# Coordinated rebuild of several datasets in worker processes.
+#
+# The sources of all due datasets are fetched concurrently, the changed ones are parsed in
+# parallel, each dataset in a worker process of its own (so the incremental
+# ingest state of a dataset lives on in its worker). The tables come back as
+# pickled arrays and all new snapshots are swapped in together, or none of
+# them if any download or parse failed.
+#
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import time
+from lcd_store import make_snapshot
+from lcd_metrics import timed
+
+_worker_data = {}
+
+def build_tables(filepath, source):
+    '''
+    Runs in the worker process of <filepath>: returns (abs_table, dif_table, tree) parsed from the current file.
+    <source> (pickled) is only used on the first call, later calls parse with the worker's copy of it.
+    '''
+    import lcd
+    data = _worker_data.get(filepath)
+    if data is None:
+        data = _worker_data[filepath] = lcd.CovidData(source=source)
+    return data._compute_tables()
+
+class ParallelRebuild:
+    '''
+    Rebuild the snapshots of a set of CovidData instances together.
+
+    The datasets in <consistent> are committed only if their data ends on the same
+    day, so e.g. confirmed cases and deaths never show data of different days.
+    '''
+    def __init__(self, datasets, interval, consistent=()):
+        self.datasets = datasets
+        self.interval = interval
+        self.consistent = consistent
+        self._pools = {}
+
+    def _pool(self, data):
+        if data.filepath not in self._pools:
+            self._pools[data.filepath] = ProcessPoolExecutor(max_workers=1)
+        return self._pools[data.filepath]
+
+    def _download(self, data):
+        '''Returns (parse needed, update time) for <data>.'''
+        if data.snapshot is None:
+            update_time = data.source.local_copy_time()
+            if update_time is not None:
+                return True, update_time
+        with timed('download'):
+            changed = data.source.fetch()
+        data.pending = data.pending or changed      # until committed, the next fetch reports the change no more
+        return data.pending or data.snapshot is None or data.warm, time()
+
+    def _check_consistency(self, snapshots):
+        last_days = {data.filepath: snapshots[data].abs_table.dates[-1] for data in self.consistent}
+        if len(set(last_days.values())) > 1 and all(data.snapshot is not None for data in self.consistent):
+            raise ValueError("datasets end on different days: %s" % last_days)
+
+    def rebuild(self, forced=()):
+        '''Rebuild all datasets due for a reload or in <forced>; raises if nothing could be committed.'''
+        locks = [data._refresh_lock for data in self.datasets]
+        for lock in locks:
+            lock.acquire()
+        try:
+            due = [data for data in self.datasets if data.snapshot is None or data.is_dirty(self.interval) or data in forced]
+            if not due:
+                return
+            with ThreadPoolExecutor(len(due)) as threads:
+                downloads = list(threads.map(self._download, due))
+            futures = {data: self._pool(data).submit(build_tables, data.filepath, data.source)
+                       for data, (parse, update_time) in zip(due, downloads) if parse}
+            snapshots = {data: data.snapshot for data in self.datasets}
+            for data, (parse, update_time) in zip(due, downloads):
+                if parse:
+                    with timed('parse_wait'):
+                        abs_table, dif_table, tree = futures[data].result()
+                    snapshots[data] = make_snapshot(abs_table, dif_table, update_time, data.version + 1, tree)
+                else:
+                    snapshots[data] = data.snapshot._replace(last_update_time=update_time)
+            self._check_consistency(snapshots)
+            for data in self.datasets:
+                previous, data.snapshot = data.snapshot, snapshots[data]
+                if data in due:
+                    data.warm = data.pending = False
+                if previous is None or data.snapshot.version != previous.version:
+                    data.archive_snapshot()
+            print("data reloaded in parallel...")
+        finally:
+            for lock in reversed(locks):
+                lock.release()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# Snapshot file shared by all worker processes.
+#
+# A single builder process downloads and parses the data and writes all
+# snapshots into one file; workers map that file read-only and use its arrays
+# without copying. A new file is written next to the old one and renamed over
+# it, so workers pick it up atomically while old mappings stay valid.
+#
+# usage: python lcd_snapshot.py <snapshot file>
+#        LCD_SNAPSHOT_FILE=<snapshot file> gunicorn lcd:app
+#
+# File layout: magic (8 bytes), header length (uint64 little endian), json header,
+# followed by the raw arrays, each aligned to ALIGNMENT bytes. The header holds
+# offset, dtype and shape of every array plus the region and date labels and
+# the names of the nodes of the region tree.
+#
+
+import os
+import sys
+import mmap
+import json
+import numpy
+import struct
+
+from time import time, sleep
+from lcd_store import SeriesTable, make_snapshot
+from lcd_hierarchy import RegionTree
+
+MAGIC = b'LCDSNAP1'
+ALIGNMENT = 64
+CHECK_INTERVAL = 10         # secs between two checks for a new snapshot file
+TABLE_ARRAYS = ('values', 'value_rows', 'population', 'residents_per_case', 'trend', 'continent')
+TREE_ARRAYS = ('parent', 'level')
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_snapshot_file(path, snapshots):
+    '''Write dict <snapshots> (dataset name -> Snapshot) to <path>, replacing an existing file atomically.'''
+    arrays = []
+    header = {'created': time(), 'snapshots': {}}
+    for key, snapshot in snapshots.items():
+        tables = {}
+        for name in ('abs_table', 'dif_table'):
+            table = getattr(snapshot, name)
+            tables[name] = {'regions': table.regions, 'dates': table.dates, 'continents': table.continents, 'arrays': {}}
+            for array_name in TABLE_ARRAYS:
+                array = numpy.ascontiguousarray(getattr(table, array_name))
+                tables[name]['arrays'][array_name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+                arrays.append((tables[name]['arrays'][array_name], array))
+        header['snapshots'][key] = {'last_update_time': snapshot.last_update_time, 'version': snapshot.version, 'tables': tables}
+        if snapshot.tree is not None:
+            tree = header['snapshots'][key]['tree'] = {'names': snapshot.tree.names, 'arrays': {}}
+            for array_name in TREE_ARRAYS:
+                array = numpy.ascontiguousarray(getattr(snapshot.tree, array_name))
+                tree['arrays'][array_name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+                arrays.append((tree['arrays'][array_name], array))
+
+    # offsets depend on header size and vice versa: reserve enough digits for the offsets first
+    for spec, array in arrays:
+        spec['offset'] = 10 ** 15
+    data_start = _aligned(16 + len(json.dumps(header).encode('utf-8')))
+    offset = data_start
+    for spec, array in arrays:
+        spec['offset'] = offset
+        offset = _aligned(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8').ljust(data_start - 16)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for spec, array in arrays:
+            f.write(b'\0' * (spec['offset'] - f.tell()))
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+def read_snapshot_file(path):
+    '''
+    Map <path> read-only and return dict dataset name -> Snapshot.
+    The arrays of the tables are views into the mapping, nothing is copied.
+    '''
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:8] != MAGIC:
+        raise ValueError("not a snapshot file: " + path)
+    header_length, = struct.unpack('<Q', buffer[8:16])
+    header = json.loads(bytes(buffer[16:16 + header_length]).decode('utf-8'))
+    def mapped(specs):
+        arrays = {}
+        for array_name, a in specs.items():
+            dtype = numpy.dtype(a['dtype'])
+            count = int(numpy.prod(a['shape']))
+            arrays[array_name] = numpy.frombuffer(buffer, dtype, count, a['offset']).reshape(a['shape'])
+        return arrays
+
+    snapshots = {}
+    for key, spec in header['snapshots'].items():
+        tables = {}
+        for name, table in spec['tables'].items():
+            tables[name] = SeriesTable(table['regions'], table['dates'], continents=table['continents'], **mapped(table['arrays']))
+        tree = RegionTree(spec['tree']['names'], **mapped(spec['tree']['arrays'])) if 'tree' in spec else None
+        snapshots[key] = make_snapshot(tables['abs_table'], tables['dif_table'], spec['last_update_time'], spec['version'], tree)
+    return snapshots
+
+class SnapshotFile:
+    '''
+    Snapshots of a snapshot file written by the builder process.
+    The file is checked for replacement at most every <check_interval> secs and mapped again if so.
+    '''
+    def __init__(self, path, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.snapshots = {}
+        self._identity = None
+        self._next_check = 0.0
+        self._missing = set()       # keys without snapshot in the current file, logged once
+
+    def get(self, key):
+        '''Returns the latest Snapshot stored for <key> (the dataset name) or None if there is none (yet).'''
+        if time() >= self._next_check:
+            self._next_check = time() + self.check_interval
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return self.snapshots.get(key)
+            identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if identity != self._identity:
+                self.snapshots = read_snapshot_file(self.path)
+                self._identity = identity
+                self._missing = set()
+        if key not in self.snapshots and self._identity is not None and key not in self._missing:
+            self._missing.add(key)
+            print("no snapshot of %s in %s" % (key, self.path))
+        return self.snapshots.get(key)
+
+def main(path):
+    '''Keep the data up to date and write a new snapshot file whenever it changed.'''
+    import lcd
+    from lcd_rebuild import ParallelRebuild
+    datasets = lcd.scheduler.datasets
+    rebuild = ParallelRebuild(datasets, lcd.REFRESH_INTERVAL, consistent=datasets[:2])
+    written = None
+    while True:
+        try:
+            rebuild.rebuild()
+        except Exception as e:          # keep the previous snapshot file
+            print("data reload failed:", e)
+        snapshots = [data.snapshot for data in datasets]
+        if None not in snapshots and snapshots != written:
+            write_snapshot_file(path, {data.name: data.snapshot for data in datasets})
+            written = snapshots
+            print("snapshot written...")
+        oldest = min(data.last_update_time for data in datasets)
+        sleep(max(oldest + lcd.REFRESH_INTERVAL - time(), lcd.RETRY_INTERVAL))
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -0,0 +1,113 @@
+#
+# Data sources of the datasets.
+#
+# A source knows where the file of a dataset comes from and how to parse it:
+# fetch() brings the local copy up to date and tells whether it changed (the
+# incremental detection: conditional download or file identity), parse() reads
+# it into the internal representation (the region tree and int32 matrices of
+# all its nodes, see ParsedSeries). CovidData only talks to its source, so any
+# dataset with cumulative numbers per region and day can be served.
+#
+# JHUSource downloads the JHU time series files, LocalDirectorySource reads a
+# file dropped into a local directory (e.g. fixtures for offline testing, or an
+# export of another pipeline): JHU time series, long format CSV (OWID) or Parquet.
+#
+
+import os
+import asyncio
+
+from collections import namedtuple
+from lcd_fetch import fetch, fetch_async, local_copy_time
+from lcd_ingest import TimeSeriesIngest, LongFormatIngest
+from lcd_country_data import get_country_continent
+
+# Result of Source.parse(): values of all nodes of <tree>, <region_rows> are the nodes shown in the tables.
+ParsedSeries = namedtuple('ParsedSeries', ['tree', 'region_rows', 'dates', 'abs_values', 'dif_values', 'days_parsed'])
+
+LAYOUTS = ('jhu', 'long', 'parquet')
+LONG_COLUMNS = ('location', 'date', 'total_cases')     # location, date and value column of long format files (OWID)
+
+class Source:
+    '''
+    Base class of the sources: the local file <filepath> is parsed by <ingest>
+    (e.g. a TimeSeriesIngest), which keeps its state between two updates.
+    '''
+    url = ''
+
+    def __init__(self, filepath, ingest):
+        self.filepath = filepath
+        self.ingest = ingest
+
+    @property
+    def location(self):
+        '''Where the data comes from, for log messages.'''
+        return self.url or self.filepath
+
+    def fetch(self):
+        '''Bring the local copy up to date; returns True if its content has changed.'''
+        raise NotImplementedError
+
+    async def fetch_async(self, session):
+        '''Same as fetch() on an event loop, with aiohttp ClientSession <session> (None if n/a).'''
+        return await asyncio.get_running_loop().run_in_executor(None, self.fetch)
+
+    def local_copy_time(self):
+        '''Returns the time of the local copy if it is intact and can be parsed without fetching, otherwise None.'''
+        return None
+
+    def parse(self):
+        '''Ingest the local copy, returns ParsedSeries.'''
+        days_parsed = self.ingest.update(self.filepath)
+        ingest = self.ingest
+        return ParsedSeries(ingest.tree, ingest.region_rows, ingest.dates, ingest.abs_values, ingest.dif_values, days_parsed)
+
+class JHUSource(Source):
+    '''JHU time series file downloaded from <url> to <filepath>, see lcd_fetch.'''
+    def __init__(self, filepath, url, last_days=None, continent_of=get_country_continent):
+        super().__init__(filepath, TimeSeriesIngest(continent_of, last_days))
+        self.url = url
+
+    def fetch(self):
+        return fetch(self.url, self.filepath)
+
+    async def fetch_async(self, session):
+        if session is None:
+            return await super().fetch_async(session)
+        return await fetch_async(session, self.url, self.filepath)
+
+    def local_copy_time(self):
+        return local_copy_time(self.filepath)
+
+class LocalDirectorySource(Source):
+    '''
+    File <filename> in local <directory>, replaced there by whoever produces it. It counts as
+    changed when its modification time or size changes.
+
+    <layout> is 'jhu' (JHU time series), 'long' (CSV with one row per location and date, e.g.
+    OWID) or 'parquet' (the same as Parquet file, requires pyarrow). <columns> are the location,
+    date and value column of the long formats.
+    '''
+    def __init__(self, directory, filename, layout='jhu', columns=LONG_COLUMNS, last_days=None, continent_of=get_country_continent):
+        if layout not in LAYOUTS:
+            raise ValueError("layout must be one of " + ', '.join(LAYOUTS))
+        if layout == 'jhu':
+            ingest = TimeSeriesIngest(continent_of, last_days)
+        else:
+            ingest = LongFormatIngest(continent_of, columns, last_days, parquet=layout == 'parquet')
+        super().__init__(os.path.join(directory, filename), ingest)
+        self.layout = layout
+        self._seen = None           # (mtime, size) of the file when it was last fetched
+
+    def _identity(self):
+        stat = os.stat(self.filepath)
+        return stat.st_mtime_ns, stat.st_size
+
+    def fetch(self):
+        identity, self._seen = self._seen, self._identity()
+        return identity != self._seen
+
+    def local_copy_time(self):
+        if not os.path.exists(self.filepath):
+            return None
+        self._seen = self._identity()
+        return self._seen[0] / 1e9
@@ -0,0 +1,192 @@
+#
+# Compact, array backed storage of the time series served by the dashboard.
+#
+
+import numpy
+
+from collections import namedtuple
+from lcd_analytics import Analytics
+from lcd_hierarchy import COUNTRY
+
+# Immutable set of tables served to requests; replaced as a whole on every reload.
+# <version> is only incremented if the data did change and is part of every cache key.
+# <index> is the RankIndex and <analytics> the (lazily computed) Analytics of the tables, see make_snapshot().
+# <tree> is the RegionTree of the rows of the table values (None if unknown), <series> the SeriesStore.
+Snapshot = namedtuple('Snapshot', ['abs_table', 'dif_table', 'last_update_time', 'version', 'index', 'analytics', 'tree', 'series'])
+
+# Result of a view: <values> holds one column per entry in <columns> for each row index of <table> in <rows>.
+TableView = namedtuple('TableView', ['table', 'rows', 'values', 'columns', 'dat_start', 'dat_end'])
+
+def argsort_descending(values):
+    '''
+    Returns the indices that sort <values> descending with NaN last.
+    Ties are ordered exactly like DataFrame.sort_values(ascending=False) does.
+    '''
+    values = numpy.asarray(values)
+    index = numpy.arange(len(values))
+    nan_mask = numpy.isnan(values) if values.dtype.kind == 'f' else numpy.zeros(len(values), dtype=bool)
+    non_nan_index = index[~nan_mask][::-1]
+    order = non_nan_index[values[~nan_mask][::-1].argsort(kind='quicksort')][::-1]
+    return numpy.concatenate([order, index[nan_mask]])
+
+def page_bounds(count, limit, offset):
+    '''Returns (start, stop) of the page of <limit> rows (all if limit <= 0) starting at <offset> of <count> rows.'''
+    start = min(max(offset, 0), count)
+    stop = count if limit <= 0 else min(start + limit, count)
+    return start, stop
+
+def relative_values(values):
+    '''
+    Compute relative numbers (%) of the max value from absolute numbers, rounded to one digit.
+    Relative numbers (percent values) are used for length of bargraphs.
+    Negative numbers are set to zero!
+    '''
+    if values.size == 0:
+        return numpy.zeros(values.shape)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rel = numpy.round(values / numpy.nanmax(values) * 100, 1)
+    rel[rel < 0] = 0
+    return rel
+
+class SeriesTable:
+    '''
+    Daily values per region held as numpy arrays, rows sorted descending by the latest value.
+
+    values is an int32 matrix (regions x days) with one column per entry in dates.
+    Its rows are not sorted: row <value_rows[i]> holds the values of row i (identity if None),
+    so a new version of the data can share the matrix with the previous one, and it may
+    hold further rows, e.g. of all nodes of the region tree, shared by several tables.
+    The metadata arrays are indexed by row like regions: population in mn (0 if unknown),
+    residents per case, trend in % (NaN if n/a) and continent as int8 code into
+    continents (-1 if n/a).
+    '''
+    def __init__(self, regions, dates, values, population, residents_per_case, trend, continent, continents, value_rows=None):
+        self.regions = list(regions)
+        self.dates = list(dates)
+        self.values = values
+        self.value_rows = numpy.arange(len(self.regions)) if value_rows is None else value_rows
+        self.latest = values[self.value_rows, -1]
+        self.population = population
+        self.residents_per_case = residents_per_case
+        self.trend = trend
+        self.continent = continent
+        self.continents = list(continents)
+        self.position = {region: row for row, region in enumerate(self.regions)}
+
+    def __len__(self):
+        return len(self.regions)
+
+    @property
+    def nbytes(self):
+        '''Size of the arrays in bytes.'''
+        return sum(a.nbytes for a in (self.values, self.value_rows, self.latest, self.population,
+                                      self.residents_per_case, self.trend, self.continent))
+
+    def count_rows_with_at_least(self, cases):
+        '''
+        Returns number of leading rows with at least <cases> in last column, all rows if cases <= 0.
+        Rows are sorted by last column, so these rows are the only ones meeting the condition
+        and their number is found by binary search.
+        '''
+        if cases <= 0:
+            return len(self)
+        return len(self) - int(numpy.searchsorted(self.latest[::-1], cases, side='left'))
+
+    def select(self, rows, days):
+        '''Returns the values of the last <days> of each row index in <rows> (a copy).'''
+        return self.values[self.value_rows[rows], -days:]
+
+    def to_rows(self, rows, values):
+        '''
+        Returns [region, population, residents per case, trend, value, ...] for each row index in <rows>,
+        where <values> holds the (sliced) values of these rows. This is the row format used by the template.
+        '''
+        regions = self.regions
+        return [[regions[row], po, rpc, tr] + va for row, po, rpc, tr, va in zip(
+            rows.tolist(),
+            self.population[rows].tolist(),
+            self.residents_per_case[rows].tolist(),
+            self.trend[rows].tolist(),
+            values.tolist())]
+
+class RankIndex:
+    '''
+    Row lookups of a snapshot for the <cases> and <country> filters, built once per snapshot.
+
+    Filtered abs rows are a leading slice of <rows>, so every filter returns a view.
+    <abs_to_dif> aligns both orderings: abs row i holds the same region as dif row abs_to_dif[i].
+    '''
+    def __init__(self, abs_table, dif_table):
+        self.abs_table = abs_table
+        self.rows = numpy.arange(len(abs_table))
+        self.abs_to_dif = numpy.array([dif_table.position[region] for region in abs_table.regions], dtype='intp')
+
+    def abs_rows(self, cases):
+        '''Returns the abs rows with at least <cases> in last column.'''
+        return self.rows[:self.abs_table.count_rows_with_at_least(cases)]
+
+    def dif_rows(self, cases):
+        '''Returns the dif rows (sorted) of the regions with at least <cases> in last abs column.'''
+        return numpy.sort(self.abs_to_dif[:self.abs_table.count_rows_with_at_least(cases)])
+
+    @staticmethod
+    def jump_to(table, rows, country):
+        '''
+        Returns the view of <rows> (sorted) starting at the row of <country>,
+        None if <country> is not among <rows>.
+        '''
+        row = table.position.get(country)
+        if row is None:
+            return None
+        pos = int(numpy.searchsorted(rows, row))
+        return rows[pos:] if pos < len(rows) and rows[pos] == row else None
+
+class SeriesStore:
+    '''
+    Complete series of the regions of a snapshot by name, for views of a few given regions.
+
+    Regions are looked up by their key in the region tree ('Germany', '[Europe]', 'US/New York'),
+    or by their name in the abs table if there is no tree. The series are the rows of the values
+    shared by all tables of the snapshot, so a lookup copies nothing but the requested rows.
+    '''
+    def __init__(self, abs_table, dif_table, tree=None):
+        self.abs_table = abs_table
+        self.dif_table = dif_table
+        self.tree = tree
+        if tree is not None:
+            self.rows = tree.position
+        else:
+            self.rows = {region: row for region, row in zip(abs_table.regions, abs_table.value_rows.tolist())}
+        self.max_parts = 1 + max((region.count(',') for region in self.rows), default=0)   # of a region name split at commas
+
+    def split(self, text):
+        '''
+        Returns the regions in comma separated <text>; names with a comma like 'Korea, South' are kept together.
+        Only joins of up to max_parts parts are looked up, so this takes linear time in the length of <text>.
+        '''
+        parts = [part.strip() for part in text.split(',')]
+        regions, start = [], 0
+        while start < len(parts):
+            stop = min(start + self.max_parts, len(parts))
+            while stop > start + 1 and ', '.join(parts[start:stop]) not in self.rows:
+                stop -= 1
+            if parts[start]:
+                regions.append(', '.join(parts[start:stop]))
+            start = stop
+        return regions
+
+    def lookup(self, regions):
+        '''Returns the known regions of <regions> (in order, without duplicates) and their rows.'''
+        known = [region for region in dict.fromkeys(regions) if region in self.rows]
+        if len(known) < len(set(regions)):
+            print(', '.join(sorted(set(regions) - set(known))), 'not found in series store')
+        return known, numpy.array([self.rows[region] for region in known], dtype='intp')
+
+    def countries(self, rows):
+        '''Returns True for each of <rows> that is a country or above, None if all are (there is no tree).'''
+        return None if self.tree is None else self.tree.level[rows] <= COUNTRY
+
+def make_snapshot(abs_table, dif_table, last_update_time, version, tree=None):
+    '''Returns Snapshot of the tables together with their RankIndex, Analytics and SeriesStore.'''
+    return Snapshot(abs_table, dif_table, last_update_time, version, RankIndex(abs_table, dif_table), Analytics(abs_table),
+                    tree, SeriesStore(abs_table, dif_table, tree))
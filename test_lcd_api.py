@@ -0,0 +1,57 @@
+#
+# Tests of the data API (lcd_api.py): the json must stay valid when a view holds values
+# that are not finite, e.g. the growth rate of a region that had no cases before.
+#
+
+import json
+import numpy
+import pytest
+
+from flask import Flask
+from lcd import CovidData
+from lcd_api import create_api, _value_max
+from lcd_sources import LocalDirectorySource
+
+DATES = ['3/%d/20' % day for day in range(1, 17)]
+ROWS = [('', 'Germany', [10 * day + 10 for day in range(16)]),
+        ('', 'France', [0] * 12 + [5, 10, 20, 40]),               # growth from 0: infinite
+        ('', 'Italy', [0] * 16),                                # 0 / 0: NaN
+        ('', 'Spain', [0] * 15 + [3])]
+
+def strict_loads(text):
+    '''json.loads rejecting Infinity and NaN, which are not json.'''
+    def reject(name):
+        raise ValueError("not json: " + name)
+    return json.loads(text, parse_constant=reject)
+
+@pytest.fixture
+def client(tmp_path):
+    lines = ['Province/State,Country/Region,Lat,Long,' + ','.join(DATES)]
+    lines += ['%s,%s,1.0,2.0,%s' % (province, country, ','.join(map(str, values))) for province, country, values in ROWS]
+    (tmp_path / 'series.csv').write_text('\n'.join(lines) + '\n')
+    data = CovidData(source=LocalDirectorySource(str(tmp_path), 'series.csv'))
+    data.refresh(force_reload=True)
+    app = Flask(__name__)
+    app.register_blueprint(create_api({'confirmed': data}))
+    return app.test_client()
+
+def test_agr_with_zero_denominators_is_valid_json(client):
+    for path in ('/api/v1/confirmed/agr?cases=0', '/api/v1/confirmed/agr?cases=0&region=[Europe]'):
+        response = client.get(path)
+        assert response.status_code == 200
+        document = strict_loads(response.get_data(as_text=True))
+        agr = dict(zip(document['region'], document['values'][0]))
+        assert agr['France'] is None and agr['Spain'] is None and agr['Italy'] is None     # inf, inf, NaN
+        assert agr['Germany'] == 8.6
+        assert document['value_max'] == max(value for value in agr.values() if value is not None)
+
+def test_page_without_any_finite_value(client):
+    document = strict_loads(client.get('/api/v1/confirmed/agr?cases=0&limit=2').get_data(as_text=True))
+    assert document['values'][0] == [None, None]
+    assert _value_max('agr', numpy.array([[numpy.inf, 0.0], [numpy.nan, 0.0]])) is None
+
+@pytest.mark.parametrize('view', ['growth7', 'doubling7', 'incidence7'])
+def test_rolling_metrics_are_valid_json(client, view):
+    response = client.get('/api/v1/confirmed/%s?cases=0&days=16' % view)
+    assert response.status_code == 200
+    strict_loads(response.get_data(as_text=True))
@@ -0,0 +1,65 @@
+#
+# Tests of the archive of data versions (lcd_archive.py): every version rebuilt from the
+# keyframes and deltas must equal the version appended.
+#
+
+import numpy
+import pytest
+
+from datetime import datetime
+from lcd_archive import SnapshotArchive, parse_as_of, KEYFRAME_INTERVAL
+from lcd_hierarchy import RegionTree
+
+PATHS = [('[Europe]', 'Germany'), ('[Europe]', 'Germany', 'Bavaria'), ('[Europe]', 'France'), ('[Asia]', 'China', 'Hubei')]
+
+def versions(count):
+    '''Yields (tree, dates, values, archive_time) of <count> versions: a new day each, revisions and a new region.'''
+    rng = numpy.random.default_rng(1)
+    daily = rng.integers(0, 50, size=(len(PATHS) + 1, count + 10))
+    for version in range(count):
+        paths = PATHS + [('[Asia]', 'Japan')] if version >= 40 else PATHS
+        days = 10 + version
+        raw = numpy.cumsum(daily[:len(paths), :days], axis=1)
+        if version % 7 == 3:
+            raw[0, days // 2] += 5                  # revised past value
+        tree = RegionTree.from_paths(paths)
+        dates = ['d%d' % day for day in range(days)]
+        yield tree, dates, tree.aggregate(raw).astype('int32'), 1000.0 + 100 * version
+
+def test_versions_are_rebuilt_exactly(tmp_path):
+    path = str(tmp_path / 'series')
+    archive = SnapshotArchive(path)
+    originals = list(versions(2 * KEYFRAME_INTERVAL + 5))
+    for number, (tree, dates, values, archive_time) in enumerate(originals):
+        assert archive.append(tree, dates, values, archive_time) == number
+    assert archive.append(*originals[-1]) is None               # unchanged
+
+    reader = SnapshotArchive(path, cache_size=2)                # cold cache: rebuilt from the files
+    assert len(reader) == len(originals)
+    keyframes = [number for number, (offset, length, keyframe) in enumerate(reader._entries) if keyframe]
+    assert keyframes == [0, KEYFRAME_INTERVAL, 40, 2 * KEYFRAME_INTERVAL]     # 40: the tree changed
+    for number in (0, 1, KEYFRAME_INTERVAL - 1, KEYFRAME_INTERVAL, KEYFRAME_INTERVAL + 7, 39, 40, 41, len(originals) - 1):
+        tree, dates, values, archive_time = originals[number]
+        archived = reader.load(number)
+        assert archived.version == number and archived.archive_time == archive_time
+        assert archived.tree.names == tree.names and numpy.array_equal(archived.tree.parent, tree.parent)
+        assert archived.dates == dates
+        assert numpy.array_equal(archived.values, values)
+    with pytest.raises(IndexError):
+        reader.load(len(originals))
+
+def test_version_at(tmp_path):
+    archive = SnapshotArchive(str(tmp_path / 'series'))
+    for tree, dates, values, archive_time in versions(3):
+        archive.append(tree, dates, values, archive_time)
+    assert archive.version_at(999.0) is None                    # before the first version
+    assert archive.version_at(1000.0) == 0
+    assert archive.version_at(1150.0) == 1
+    assert archive.version_at(1e12) == 2
+
+def test_parse_as_of():
+    assert parse_as_of('2020-04-01') == datetime(2020, 4, 1, 23, 59, 59, 999999).timestamp()
+    assert parse_as_of('2020-04-01T12:00') == datetime(2020, 4, 1, 12, 0).timestamp()
+    for text in ('yesterday', '2020-13-01', '01.04.2020', '2020-04-01T25:00', ''):
+        with pytest.raises(ValueError):
+            parse_as_of(text)
@@ -0,0 +1,80 @@
+#
+# Tests of the conditional download (lcd_fetch.py) against a local HTTP server
+# standing in for Github: python -m pytest test_lcd_fetch.py
+#
+
+import os
+import threading
+import http.server
+import pytest
+
+from lcd_fetch import fetch, local_copy_time
+from lcd_sources import JHUSource
+
+FILE_V1 = b"Province/State,Country/Region,Lat,Long,3/20/20,3/21/20\n,Germany,51,9,100,150\n,France,46,2,80,90\n"
+FILE_V2 = b"Province/State,Country/Region,Lat,Long,3/20/20,3/21/20,3/22/20\n,Germany,51,9,100,150,170\n,France,46,2,80,90,95\n"
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    '''Serves <server.content> with an ETag and answers If-None-Match with 304 like Github.'''
+    def do_GET(self):
+        etag = '"%x"' % hash(self.server.content)
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(self.server.content)))
+        self.end_headers()
+        self.wfile.write(self.server.content)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    server.content, server.requests = FILE_V1, []
+    server.url = 'http://127.0.0.1:%d/time_series.csv' % server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_download_not_modified_changed_and_restart(server, tmp_path):
+    filepath = str(tmp_path / 'time_series.csv')
+    assert local_copy_time(filepath) is None
+
+    assert fetch(server.url, filepath)                              # 200: downloaded
+    assert open(filepath, 'rb').read() == FILE_V1
+    assert 'If-None-Match' not in server.requests[-1]
+
+    assert not fetch(server.url, filepath)                          # 304: kept
+    assert server.requests[-1]['If-None-Match']
+    assert open(filepath, 'rb').read() == FILE_V1
+
+    server.content = FILE_V2
+    assert fetch(server.url, filepath)                              # 200: changed
+    assert open(filepath, 'rb').read() == FILE_V2
+
+    server.shutdown()                                               # restart without network
+    source = JHUSource(filepath, server.url)
+    assert source.local_copy_time() is not None
+    parsed = source.parse()
+    assert parsed.dates == ['3/20/20', '3/21/20', '3/22/20']
+    assert parsed.abs_values[parsed.tree.find('Germany'), -1] == 170
+
+def test_damaged_local_copy_is_downloaded_again(server, tmp_path):
+    filepath = str(tmp_path / 'time_series.csv')
+    assert fetch(server.url, filepath)
+    with open(filepath, 'ab') as f:
+        f.write(b',Nowhere,0,0,1,2\n')
+    assert local_copy_time(filepath) is None                        # not parsed without asking the server
+
+    assert fetch(server.url, filepath)                              # no conditional headers, so no 304
+    assert 'If-None-Match' not in server.requests[-1]
+    assert open(filepath, 'rb').read() == FILE_V1
+    assert local_copy_time(filepath) is not None
+    assert not fetch(server.url, filepath)
+    assert os.path.exists(filepath + '.meta')
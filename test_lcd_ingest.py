@@ -0,0 +1,118 @@
+#
+# Tests of the incremental ingest (lcd_ingest.py): an update that only parses the appended
+# date columns must give the same result as parsing the whole file afresh.
+#
+
+import numpy
+import pytest
+
+from lcd_ingest import TimeSeriesIngest
+
+DATES = ['3/%d/20' % day for day in range(1, 11)]
+ROWS = [('', 'Germany', [10 * day for day in range(10)]),
+        ('Bavaria', 'Germany', [3 * day for day in range(10)]),
+        ('', 'France', [day * day for day in range(10)]),
+        ('Hubei', 'China', [100 + day for day in range(10)]),
+        ('', 'Korea, South', [5, 5, 6, 8, 8, 9, 12, 12, 13, 20])]
+
+def continent_of(country):
+    return {'Germany': 'Europe', 'France': 'Europe'}.get(country, 'Asia')
+
+def write(path, days, rows=ROWS, newline='\n'):
+    '''Writes a JHU time series file with the first <days> dates of <rows>.'''
+    lines = ['Province/State,Country/Region,Lat,Long,' + ','.join(DATES[:days])]
+    for province, country, values in rows:
+        country = '"%s"' % country if ',' in country else country
+        lines.append('%s,%s,1.0,2.0,%s' % (province, country, ','.join(str(value) for value in values[:days])))
+    with open(path, 'w', newline='') as f:
+        f.write(newline.join(lines) + newline)
+
+def assert_same(ingest, path):
+    fresh = TimeSeriesIngest(continent_of)
+    fresh.update(path)
+    assert ingest.tree.keys == fresh.tree.keys
+    assert ingest.dates == fresh.dates
+    assert ingest.regions == fresh.regions
+    assert numpy.array_equal(ingest.region_rows, fresh.region_rows)
+    assert numpy.array_equal(ingest.abs_values, fresh.abs_values)
+    assert numpy.array_equal(ingest.dif_values, fresh.dif_values)
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+def test_appended_columns_are_parsed_incrementally(tmp_path, newline):
+    path = str(tmp_path / 'series.csv')
+    write(path, 6, newline=newline)
+    ingest = TimeSeriesIngest(continent_of)
+    assert ingest.update(path) == 6
+    write(path, 7, newline=newline)
+    assert ingest.update(path) == 1
+    assert_same(ingest, path)
+    write(path, 10, newline=newline)
+    assert ingest.update(path) == 3
+    assert_same(ingest, path)
+    assert ingest.abs_values[ingest.tree.find('Europe'), -1] == 90 + 27 + 81
+
+def test_unchanged_file_is_parsed_again(tmp_path):
+    path = str(tmp_path / 'series.csv')
+    write(path, 8)
+    ingest = TimeSeriesIngest(continent_of)
+    ingest.update(path)
+    assert ingest.update(path) == 8
+    assert_same(ingest, path)
+
+def test_line_endings_changed(tmp_path):
+    path = str(tmp_path / 'series.csv')
+    write(path, 6)
+    ingest = TimeSeriesIngest(continent_of)
+    ingest.update(path)
+    write(path, 7, newline='\r\n')
+    ingest.update(path)
+    assert_same(ingest, path)
+
+def test_revised_past_value_falls_back_to_full_parse(tmp_path):
+    path = str(tmp_path / 'series.csv')
+    write(path, 6)
+    ingest = TimeSeriesIngest(continent_of)
+    ingest.update(path)
+    rows = [row if row[1] != 'France' else (row[0], row[1], [0, 1, 4, 7, 16] + row[2][5:]) for row in ROWS]
+    write(path, 7, rows)                    # same length of the line, other content: caught by the CRC
+    assert ingest.update(path) == 7
+    assert_same(ingest, path)
+    assert ingest.abs_values[ingest.tree.find('France'), 3] == 7
+
+def test_new_row_falls_back_to_full_parse(tmp_path):
+    path = str(tmp_path / 'series.csv')
+    write(path, 6)
+    ingest = TimeSeriesIngest(continent_of)
+    ingest.update(path)
+    write(path, 7, ROWS + [('', 'Japan', list(range(10)))])
+    assert ingest.update(path) == 7
+    assert_same(ingest, path)
+    assert 'Japan' in ingest.regions
+
+def test_removed_row_falls_back_to_full_parse(tmp_path):
+    path = str(tmp_path / 'series.csv')
+    write(path, 6)
+    ingest = TimeSeriesIngest(continent_of)
+    ingest.update(path)
+    write(path, 7, ROWS[:-1])
+    assert ingest.update(path) == 7
+    assert_same(ingest, path)
+    assert 'Korea, South' not in ingest.regions
+
+def test_last_days_always_parses_fully(tmp_path):
+    path = str(tmp_path / 'series.csv')
+    write(path, 9)
+    ingest = TimeSeriesIngest(continent_of, last_days=4)
+    ingest.update(path)
+    write(path, 10)
+    assert ingest.update(path) == 4
+    assert ingest.dates == DATES[6:10]
+    full = TimeSeriesIngest(continent_of)
+    full.update(path)
+    assert numpy.array_equal(ingest.abs_values, full.abs_values[:, -4:])
+
+def test_number_out_of_int32_range_raises(tmp_path):
+    path = str(tmp_path / 'series.csv')
+    write(path, 3, [('', 'Germany', [1, 2, 3000000000])])
+    with pytest.raises(OverflowError):
+        TimeSeriesIngest(continent_of).update(path)
@@ -0,0 +1,53 @@
+#
+# Tests of the row order and the row filters of the tables (lcd_store.py), which the pages
+# depend on byte for byte: ties ordered like pandas did and the <cases> threshold boundaries.
+#
+
+import numpy
+import pytest
+
+from lcd_store import SeriesTable, RankIndex, argsort_descending
+
+def table(regions, latest, order=None):
+    '''Returns SeriesTable of <regions> with the last values <latest>, rows in <order> (sorted descending if None).'''
+    order = argsort_descending(latest) if order is None else numpy.asarray(order)
+    values = numpy.column_stack([numpy.zeros(len(latest)), latest]).astype('int32')
+    count = len(regions)
+    return SeriesTable([regions[row] for row in order], ['3/1/20', '3/2/20'], values, numpy.zeros(count),
+                       numpy.zeros(count), numpy.full(count, numpy.nan), numpy.full(count, -1, dtype='int8'), [], order)
+
+def test_argsort_descending_ties_and_nan():
+    assert argsort_descending([3, 1, 3, 2, 3]).tolist() == [0, 2, 4, 3, 1]
+    assert argsort_descending([1.0, numpy.nan, 2.0, numpy.nan, 2.0]).tolist() == [2, 4, 0, 1, 3]
+    assert argsort_descending([]).tolist() == []
+
+def test_argsort_descending_like_pandas():
+    pandas = pytest.importorskip('pandas')
+    rng = numpy.random.default_rng(3)
+    for size in (5, 50, 500):
+        values = rng.integers(0, 8, size).astype('float64')
+        values[rng.random(size) < 0.1] = numpy.nan
+        expected = pandas.Series(values).sort_values(ascending=False).index.to_numpy()
+        assert argsort_descending(values).tolist() == expected.tolist()
+        assert argsort_descending(values[~numpy.isnan(values)].astype('int32')).tolist() == \
+            pandas.Series(values[~numpy.isnan(values)]).sort_values(ascending=False).index.tolist()
+
+@pytest.mark.parametrize('cases, count', [(-5, 6), (0, 6), (1, 5), (10, 5), (11, 4), (50, 4), (51, 1), (100, 1), (101, 0)])
+def test_count_rows_with_at_least(cases, count):
+    abs_table = table(['a', 'b', 'c', 'd', 'e', 'f'], [50, 100, 10, 50, 0, 50])
+    assert abs_table.count_rows_with_at_least(cases) == count
+
+def test_rank_index_boundaries():
+    regions = ['a', 'b', 'c', 'd', 'e']
+    abs_table = table(regions, [50, 100, 10, 50, 0])            # abs order: b, a, d, c, e
+    dif_table = table(regions, [5, 1, 7, 5, 0])                 # dif order: c, a, d, b, e
+    assert abs_table.regions == ['b', 'a', 'd', 'c', 'e']
+    assert dif_table.regions == ['c', 'a', 'd', 'b', 'e']
+    index = RankIndex(abs_table, dif_table)
+    assert index.abs_rows(50).tolist() == [0, 1, 2]
+    assert index.abs_rows(51).tolist() == [0]
+    assert [dif_table.regions[row] for row in index.dif_rows(50)] == ['a', 'd', 'b']
+    assert [dif_table.regions[row] for row in index.dif_rows(10)] == ['c', 'a', 'd', 'b']
+    assert index.dif_rows(101).tolist() == []
+    assert RankIndex.jump_to(abs_table, index.abs_rows(10), 'a').tolist() == [1, 2, 3]
+    assert RankIndex.jump_to(abs_table, index.abs_rows(50), 'c') is None